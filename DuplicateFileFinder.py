@@ -1,15 +1,30 @@
+import time
+STARTUP_TIME = time.perf_counter()  # For --startup-time, taken before the slow imports
+
 import sys
 import os
 import hashlib
-import subprocess
-import send2trash
-import zipfile
-from PyQt5.QtWidgets import QMessageBox, QInputDialog, QLineEdit, QMenu, QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QPushButton, QLabel, QTreeWidget, QTreeWidgetItem, QHeaderView, QListWidget, QFileDialog, QLineEdit, QHBoxLayout, QRadioButton, QButtonGroup, QProgressBar, QLabel, QAbstractItemView, QListWidgetItem, QTableWidgetItem, QTableWidget, QCheckBox, QTextEdit, QFileSystemModel, QTreeView, QSplitter, QSpacerItem, QSizePolicy
+import sqlite3
+import math
+from PyQt5.QtWidgets import QMessageBox, QInputDialog, QLineEdit, QMenu, QApplication, QMainWindow, QTabWidget, QWidget, QVBoxLayout, QPushButton, QLabel, QTreeWidget, QTreeWidgetItem, QHeaderView, QListWidget, QFileDialog, QLineEdit, QHBoxLayout, QRadioButton, QButtonGroup, QProgressBar, QLabel, QAbstractItemView, QListWidgetItem, QTableWidgetItem, QTableWidget, QCheckBox, QComboBox, QTextEdit, QFileSystemModel, QTreeView, QSplitter, QSpacerItem, QSizePolicy
 from PyQt5.QtGui import QCursor, QFont
-from PyQt5.QtCore import Qt, QThread, QDir, QFile, QTimer, pyqtSignal
+from PyQt5.QtCore import Qt, QThread, QDir, QFile, QTimer, pyqtSignal, QAbstractItemModel, QModelIndex
+
+from DuplicateFinderEngine import (SAMPLE_BLOCK_SIZE, SAMPLE_BLOCKS, DEFAULT_HASH_WORKERS, DEFAULT_HASH_ALGORITHM,
+                                   DEFAULT_HASH_BLOCK_SIZE, HASH_IO_STRATEGIES, DuplicateScanner,
+                                   DuplicateIndex, HashEngine, HashCache, format_progress,
+                                   available_hash_algorithms, benchmark_hash_algorithms, benchmark_io_strategies,
+                                   export_results, BatchJournal, run_batch, unfinished_journals, latest_undoable_journal,
+                                   IMAGE_HASHES, DEFAULT_IMAGE_HASH, DEFAULT_IMAGE_DISTANCE, pillow_available,
+                                   DEFAULT_DATE_TOLERANCE, verify_groups, parse_date)
+
+# send2trash, zipfile and subprocess are imported where they are used, so
+# they don't slow down starting the program
 
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
+# Groups are shown expanded when there are at most this many, expanding more makes the view slow
+EXPAND_GROUPS_LIMIT = 10000
+# Groups found by a search are shown at most this many milliseconds late, see on_groups_found
+MAX_GROUPS_DELAY = 5000
 
 class MainWindow(QMainWindow):
     VERSION = "0.4"
@@ -20,11 +35,12 @@ class MainWindow(QMainWindow):
         self.setWindowTitle(f"Duplicate File Finder v{self.VERSION}")
 
         tabwidget = QTabWidget()
-        self.search_directories_tab = SearchDirectoriesTab()  # Store this instance in a variable
-        self.delete_options_tab = DeleteOptionsTab()  # Store this instance in a variable
-        self.search_criteria_tab = SearchCriteriaTab()  # Store this instance in a variable
+        # Tabs other than Duplicates are only built when they are first shown or used
+        self.search_directories_tab = LazyTab(SearchDirectoriesTab)  # Store this instance in a variable
+        self.delete_options_tab = LazyTab(DeleteOptionsTab)  # Store this instance in a variable
+        self.search_criteria_tab = LazyTab(SearchCriteriaTab)  # Store this instance in a variable
         self.duplicates_tab = DuplicatesTab(self.search_directories_tab, self.delete_options_tab, self.search_criteria_tab)  # Pass it to DuplicatesTab
-        self.help_tab = HelpTab(self.VERSION)
+        self.help_tab = LazyTab(HelpTab, self.VERSION)
 
         tabwidget.addTab(self.duplicates_tab, "Duplicates")
         tabwidget.addTab(self.search_directories_tab, "Search Directories")
@@ -33,78 +49,320 @@ class MainWindow(QMainWindow):
         tabwidget.addTab(self.help_tab, "Help")        
         self.setCentralWidget(tabwidget)
 
-class DuplicatesFinderThread(QThread):
-    progress_signal = pyqtSignal(int)  # Signal to emit progress (if needed)
-    finished_signal = pyqtSignal(list)  # Signal to notify when the task is done with results
+class LazyTab(QWidget):
+    """Stands in for a tab and builds it the first time it is shown or widget() is called."""
 
-    def __init__(self, directories, search_criteria, get_hash_method):
+    def __init__(self, tab_class, *args):
+        super(LazyTab, self).__init__()
+        self.tab_class = tab_class
+        self.tab_args = args
+        self.tab = None
+        self.setLayout(QVBoxLayout())
+        self.layout().setContentsMargins(0, 0, 0, 0)
+
+    def widget(self):
+        if self.tab is None:
+            self.tab = self.tab_class(*self.tab_args)
+            self.layout().addWidget(self.tab)
+        return self.tab
+
+    def showEvent(self, event):
+        self.widget()
+        super(LazyTab, self).showEvent(event)
+
+class ExportThread(QThread):
+    progress_signal = pyqtSignal(int, int)  # Signal with the number of files written and the total
+    finished_signal = pyqtSignal(str, str)  # Signal with the file path and an error message, empty if it worked
+
+    def __init__(self, store, file_path, export_format, group_order=None):
         super().__init__()
-        self.directories = directories
-        self.search_criteria = search_criteria
-        self.get_hash = get_hash_method
+        self.store = store
+        self.file_path = file_path
+        self.export_format = export_format
+        self.group_order = group_order
 
     def run(self):
-        file_dict = {}
-        search_inside_zip = self.search_criteria.get('search_inside_zip', False)
-        
-        min_size = self.search_criteria['min_file_size']
-        max_size = self.search_criteria['max_file_size']
-        allowed_extensions = self.search_criteria.get('file_extensions', set())
-        skip_extensions = set(self.search_criteria.get('skip_extensions', []))
+        try:
+            export_results(self.store, self.file_path, self.export_format, self.group_order, self.progress_signal.emit)
+        except Exception as e:
+            # Anything raised here would abort the program, so every error is reported instead
+            self.finished_signal.emit(self.file_path, str(e))
+        else:
+            self.finished_signal.emit(self.file_path, "")
 
-        if not self.directories:
-            self.finished_signal.emit([])
-            return
+class BatchThread(QThread):
+    progress_signal = pyqtSignal(int, int)  # Signal with the number of actions finished and the total
+    finished_signal = pyqtSignal(object, list, list)  # Signal with the journal, the item numbers that worked and the errors
 
-        for directory, _ in self.directories:
-            for foldername, subfolders, filenames in os.walk(directory):
-                for filename in filenames:
-                    file_path = os.path.join(foldername, filename)
-                    file_size = os.path.getsize(file_path) // 1024  # Get file size in KB
-                    file_extension = os.path.splitext(filename)[1][1:].lower()  # Convert to lowercase for consistent checking
-
-                    # Checks before processing
-                    if not (min_size <= file_size <= max_size):
-                        continue
-                    if allowed_extensions and file_extension not in allowed_extensions:
-                        continue
-                    if file_extension in skip_extensions:
-                        continue
-
-                    # Regular file handling
-                    file_dict[file_path] = self.get_hash(file_path)
-
-                    # ZIP file handling
-                    if search_inside_zip and file_extension == 'zip':
-                        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                            for zip_info in zip_ref.infolist():
-                                with zip_ref.open(zip_info.filename, 'r') as file_in_zip:
-                                    file_content = file_in_zip.read()
-                                    hash_of_file = hashlib.sha256(file_content).hexdigest()
-                                    file_dict[f"{file_path}_inside_zip/{zip_info.filename}"] = hash_of_file
-
-        hashes = {}
-        for file, hash in file_dict.items():
-            hashes.setdefault(hash, []).append(file)
-
-        duplicates = [files for files in hashes.values() if len(files) > 1]
-        self.finished_signal.emit(duplicates)
+    def __init__(self, journal, undo=False):
+        super().__init__()
+        self.journal = journal
+        self.undo = undo
+
+    def run(self):
+        succeeded, errors = run_batch(self.journal, self.undo, progress=self.progress_signal.emit)
+        self.finished_signal.emit(self.journal, succeeded, errors)
+
+class VerifyThread(QThread):
+    progress_signal = pyqtSignal(int, int)  # Signal with the number of files hashed and the total
+    finished_signal = pyqtSignal(list, list)  # Signal with the group ids that were checked and the identical groups found
+
+    def __init__(self, group_ids, groups, hash_engine, hash_cache=None):
+        super().__init__()
+        self.group_ids = group_ids
+        self.groups = groups
+        self.hash_engine = hash_engine
+        self.hash_cache = hash_cache
+
+    def run(self):
+        verified = verify_groups(self.groups, self.hash_engine, self.hash_cache, progress=self.progress_signal.emit)
+        self.finished_signal.emit(self.group_ids, verified)
+
+class BenchmarkThread(QThread):
+    finished_signal = pyqtSignal(object, object, str)  # Signal with the algorithm speeds, the reading strategy results and an error message
+
+    def __init__(self, block_size):
+        super().__init__()
+        self.block_size = block_size
+
+    def run(self):
+        # Time every algorithm, then time the ways of reading files with the fastest one
+        try:
+            results = benchmark_hash_algorithms(block_size=self.block_size)
+            io_results = benchmark_io_strategies(HashEngine(next(iter(results)), self.block_size))
+        except OSError as e:
+            self.finished_signal.emit({}, {}, str(e))
+        else:
+            self.finished_signal.emit(results, io_results, "")
 
+class DuplicatesFinderThread(QThread):
+    progress_signal = pyqtSignal(dict)  # Signal with ScanProgress snapshots, a few times a second
+    stats_signal = pyqtSignal(dict)  # Signal with the number of files removed at each search stage
+    groups_signal = pyqtSignal(list)  # Signal with batches of DuplicateGroups as soon as they are confirmed
+    finished_signal = pyqtSignal(list)  # Signal to notify when the task is done with results
+    error_signal = pyqtSignal(str)  # Signal with the error message when the search failed, instead of finished_signal
+
+    def __init__(self, directories, search_criteria, hash_cache=None):
+        super().__init__()
+        # The search itself is done by the engine, the thread only passes its results on as signals
+        self.scanner = DuplicateScanner(directories, search_criteria, hash_cache, self.progress_signal.emit,
+                                        self.stats_signal.emit, self.groups_signal.emit)
+        self.hash_engine = None
 
+    def run(self):
+        try:
+            duplicates = self.scanner.run()
+        except Exception as e:
+            # An exception leaving run() would abort the program, like a file that isn't a reference index
+            self.error_signal.emit(str(e))
+            return
+        self.hash_engine = self.scanner.hash_engine
+        self.finished_signal.emit(duplicates)
 
-class NumericTreeWidgetItem(QTreeWidgetItem):
-    def __lt__(self, other):
-        column = self.treeWidget().sortColumn()
 
-        # Check if the column we're sorting is the file size column (column 3 in your case)
+class DuplicatesModel(QAbstractItemModel):
+    """Tree model over a DuplicateIndex: one top level row per duplicate group, its files under it.
+
+    Text is only built for the rows the view asks for. Child indexes carry their
+    group id, so they stay valid however the groups are sorted. Files picked by
+    the select menu are ticked in checked, not put in the view's selection.
+    """
+    HEADERS = ["Filename", "Duplicate ID", "File Path", "File Size (KB)", "Percent Similar"]
+    GROUP_FLAGS = Qt.ItemIsSelectable | Qt.ItemIsEnabled
+    FILE_FLAGS = Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemNeverHasChildren
+    FILE_NAME_FLAGS = FILE_FLAGS | Qt.ItemIsUserCheckable
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = DuplicateIndex()
+        self.group_order = []
+        self.group_position = {}
+        self.checked = set()  # store rows of the ticked files
+        self.sort_column = 1
+        self.sort_order = Qt.AscendingOrder
+
+    def set_store(self, store):
+        self.beginResetModel()
+        self.store = store
+        self.checked = set()
+        self.group_order = list(store.group_rows)
+        self.sort_groups()
+        self.endResetModel()
+
+    # Qt model interface
+
+    def index(self, row, column, parent=QModelIndex()):
+        # The view calls this for every row on each layout, so the bounds are checked here
+        # instead of with hasIndex(), which calls rowCount() and columnCount() back in Python
+        if row < 0 or not 0 <= column < len(self.HEADERS):
+            return QModelIndex()
+        if not parent.isValid():
+            if row >= len(self.group_order):
+                return QModelIndex()
+            return self.createIndex(row, column, 0)
+        if parent.internalId() != 0 or parent.row() >= len(self.group_order):
+            return QModelIndex()
+        group_id = self.group_order[parent.row()]
+        if row >= len(self.store.group_rows[group_id]):
+            return QModelIndex()
+        return self.createIndex(row, column, group_id)
+
+    def parent(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(self.group_position[index.internalId()], 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.group_order)
+        if parent.internalId() == 0:
+            return len(self.store.group_rows[self.group_order[parent.row()]])
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        column = index.column()
+        if role == Qt.TextAlignmentRole and column in (1, 3, 4):
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        if role == Qt.CheckStateRole and column == 0 and index.internalId() != 0:
+            return Qt.Checked if self.row_at(index) in self.checked else Qt.Unchecked
+        if role != Qt.DisplayRole:
+            return None
+
+        if index.internalId() == 0:
+            # Group row
+            group_id = self.group_order[index.row()]
+            rows = self.store.group_rows[group_id]
+            if column == 0:
+                # Groups matched on file details only may not be duplicates at all
+                return f"{len(rows)} files" + (" (unverified)" if group_id in self.store.unverified else "")
+            if column == 1:
+                return group_id
+            if column == 3:
+                return "{:.1f}".format(self.store.sizes[rows[0]] / 1024)
+            return None
+
+        row = self.row_at(index)
+        if column == 0:
+            links = self.store.links.get(row)
+            return self.store.filename(row) + (f" (+{len(links)} hardlinks)" if links else "")
+        if column == 1:
+            return self.store.group_ids[row]
+        if column == 2:
+            return self.store.folder(row)
         if column == 3:
-            return float(self.text(column)) < float(other.text(column))
-        
-        return super(NumericTreeWidgetItem, self).__lt__(other)
+            return "{:.1f}".format(self.store.sizes[row] / 1024)  # Size in KB
+        similarity = self.store.similarity[row]
+        return None if math.isnan(similarity) else "{:.1f}".format(similarity)
+
+    def flags(self, index):
+        # Called for every row on each layout, so no call back into Qt. Files are marked as
+        # never having children, which spares the view a rowCount() call for each of them
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if index.internalId() == 0:
+            return self.GROUP_FLAGS
+        return self.FILE_NAME_FLAGS if index.column() == 0 else self.FILE_FLAGS
+
+    def setData(self, index, value, role=Qt.EditRole):
+        row = self.row_at(index)
+        if role != Qt.CheckStateRole or row is None:
+            return False
+        if value == Qt.Checked:
+            self.checked.add(row)
+        else:
+            self.checked.discard(row)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        return True
+
+    def append_groups(self, groups):
+        """Add groups after the ones shown, without sorting the groups already shown again."""
+        first = len(self.group_order)
+        self.beginInsertRows(QModelIndex(), first, first + len(groups) - 1)
+        for group in groups:
+            group_id = self.store.add_group(group)
+            self.store.group_rows[group_id].sort(key=lambda row: self.store.sort_key(row, self.sort_column),
+                                                 reverse=self.sort_order == Qt.DescendingOrder)
+            self.group_position[group_id] = len(self.group_order)
+            self.group_order.append(group_id)
+        self.endInsertRows()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.change_layout(self.sort_groups)
+
+    # Helpers for the tab
+
+    def row_at(self, index):
+        """Store row of a file index, or None for a group index."""
+        if not index.isValid() or index.internalId() == 0:
+            return None
+        return self.store.group_rows[index.internalId()][index.row()]
+
+    def index_of_row(self, row, column=0):
+        group_id = self.store.group_ids[row]
+        return self.createIndex(self.store.group_rows[group_id].index(row), column, group_id)
+
+    def sort_groups(self):
+        store = self.store
+        column = self.sort_column
+        reverse = self.sort_order == Qt.DescendingOrder
+        for rows in store.group_rows.values():
+            rows.sort(key=lambda row: store.sort_key(row, column), reverse=reverse)
+        if column == 1:
+            self.group_order.sort(reverse=reverse)
+        else:
+            # Groups are ordered by their first file after the files are sorted
+            self.group_order.sort(key=lambda group_id: store.sort_key(store.group_rows[group_id][0], column), reverse=reverse)
+        self.group_position = {group_id: position for position, group_id in enumerate(self.group_order)}
+
+    def set_checked(self, rows):
+        """Tick exactly these files. The caller repaints the view, a dataChanged per group would be slow."""
+        self.checked = set(rows)
+
+    def remove_rows(self, rows):
+        """Remove files from the store and the view, along with groups left with fewer than two files."""
+        def update():
+            self.store.remove_rows(rows)
+            self.checked = {row for row in self.checked if self.store.alive[row]}
+            self.group_order = [group_id for group_id in self.group_order if group_id in self.store.group_rows]
+            self.group_position = {group_id: position for position, group_id in enumerate(self.group_order)}
+        self.change_layout(update)
+
+    def change_layout(self, update):
+        # Keep persistent indexes (selection, current row, expanded groups) on the same files
+        self.layoutAboutToBeChanged.emit()
+        old_indexes = self.persistentIndexList()
+        keys = [(index.internalId(), self.group_order[index.row()] if index.internalId() == 0 else self.row_at(index), index.column())
+                for index in old_indexes]
+        update()
+        new_indexes = []
+        for group_id, item, column in keys:
+            if group_id == 0:
+                position = self.group_position.get(item)
+                new_indexes.append(self.createIndex(position, column, 0) if position is not None else QModelIndex())
+            elif self.store.alive[item] and group_id in self.store.group_rows:
+                new_indexes.append(self.index_of_row(item, column))
+            else:
+                new_indexes.append(QModelIndex())
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
 
 class DuplicatesTab(QWidget):
     def __init__(self, search_directories_tab, delete_options_tab, search_criteria_tab, *args, **kwargs):  # Add search_criteria_tab argument
         super(DuplicatesTab, self).__init__(*args, **kwargs)
+        # These are LazyTabs, widget() gives the tab itself
         self.search_directories_tab = search_directories_tab  # Save reference to the SearchDirectoriesTab
         self.delete_options_tab = delete_options_tab  # Save reference to the DeleteOptionsTab
         self.search_criteria_tab = search_criteria_tab  # Save reference to the SearchCriteriaTab
@@ -113,8 +371,13 @@ class DuplicatesTab(QWidget):
         self.progress_label.setStyleSheet("color: red; background-color: yellow;")
         self.progress_label.setMinimumSize(100, 20)
         self.progress_label.hide()
-        self.hashes = {}
-        self.selected_rows = set()
+        # Files are rehashed with the algorithm of the last search, so digests stay comparable
+        self.hash_engine = HashEngine()
+        try:
+            self.hash_cache = HashCache()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Hash cache disabled: {e}")
+            self.hash_cache = None
 
         layout = QVBoxLayout()
 
@@ -123,24 +386,35 @@ class DuplicatesTab(QWidget):
         self.flashing_timer.timeout.connect(self.toggle_searching_visibility)
         self.flashing_timer.setInterval(500)  # Toggle visibility every 500 milliseconds
 
-        # Create the horizontal layout for the "Export to Excel" button
+        # Groups from the search wait here until the timer adds them to the view
+        self.pending_groups = []
+        self.groups_timer = QTimer(self)
+        self.groups_timer.setSingleShot(True)
+        self.groups_timer.timeout.connect(self.show_pending_groups)
+
+        # Create the horizontal layout for the "Export..." button
         export_layout = QHBoxLayout()
-        # Add the "Searching..." label to the layout
+        # Add the "Searching..." label and the progress bar to the layout
         export_layout.addWidget(self.progress_label)
+        export_layout.addWidget(self.progress)
+        self.progress.hide()
         # Add a stretch to push the button to the right
         export_layout.addStretch()
         # Create and setup the "Export to Excel" button
-        self.export_button = QPushButton("Export to Excel")
-        self.export_button.clicked.connect(self.export_to_excel)
+        self.export_button = QPushButton("Export...")
+        self.export_button.clicked.connect(self.export_to_file)
         export_layout.addWidget(self.export_button)
 
         # Add the horizontal layout to the main layout
         layout.addLayout(export_layout)
         
-        # Create the treeview
-        self.tree = QTreeWidget()
-        self.tree.setSortingEnabled(True)  # Allow sorting in QTreeWidget
-        self.tree.setHeaderLabels(["Filename", "Duplicate ID", "File Path", "File Size (KB)", "Percent Similar"])
+        # Create the treeview, the model only builds the rows that are on screen
+        self.model = DuplicatesModel(self)
+        self.tree = QTreeView()
+        self.tree.setModel(self.model)
+        self.tree.setUniformRowHeights(True)  # Lets the view skip measuring rows it doesn't show
+        self.tree.setSortingEnabled(True)  # Allow sorting by clicking a column header
+        self.tree.sortByColumn(1, Qt.AscendingOrder)
         layout.addWidget(self.tree)
         self.tree.setColumnWidth(0, 300)  # Change the number as per your requirement
         self.tree.setColumnWidth(2, 300)
@@ -153,6 +427,19 @@ class DuplicatesTab(QWidget):
         self.delete_button = QPushButton("Delete Selected Files")
         self.delete_button.clicked.connect(self.delete_selected)
         layout.addWidget(self.delete_button)
+
+        journal_layout = QHBoxLayout()
+        self.resume_button = QPushButton("Resume Unfinished Actions")
+        self.resume_button.clicked.connect(self.resume_batch)
+        journal_layout.addWidget(self.resume_button)
+        self.undo_button = QPushButton("Undo Last Moves/Hardlinks")
+        self.undo_button.clicked.connect(self.undo_batch)
+        journal_layout.addWidget(self.undo_button)
+        layout.addLayout(journal_layout)
+
+        self.verify_button = QPushButton("Verify Selected Groups by Hash")
+        self.verify_button.clicked.connect(self.verify_selected_groups)
+        layout.addWidget(self.verify_button)
         
         self.deselect_all_button = QPushButton("Deselect All", self)
         self.deselect_all_button.clicked.connect(self.deselect_all)
@@ -168,288 +455,436 @@ class DuplicatesTab(QWidget):
         layout.addWidget(self.duplicate_files_label)
         self.space_to_free_label = QLabel("Space to be freed: 0.00 MB")
         layout.addWidget(self.space_to_free_label)
+        self.scan_stats_label = QLabel("")
+        layout.addWidget(self.scan_stats_label)
 
         self.setLayout(layout)
 
-#        self.tree.selectionChanged.connect(self.save_selection)  # Moved this line inside __init__ method
-#        self.tree.selectionChanged.connect(self.clear_selection)  # Moved this line inside __init__ method
-
         self.tree.customContextMenuRequested.connect(self.handle_context_menu)
         self.tree.setContextMenuPolicy(Qt.CustomContextMenu)
         self.tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.tree.setSelectionBehavior(QAbstractItemView.SelectRows)
               
     def find_duplicates(self):
         # Fetch the directories list here
-        directories = self.search_directories_tab.get_directories()
+        directories = self.search_directories_tab.widget().get_directories()
 
         if not directories:  # Optionally, you can check if directories are provided
             QMessageBox.warning(self, "Warning", "No directories selected.")
             return
 
+        search_criteria_tab = self.search_criteria_tab.widget()
+        reference_index = search_criteria_tab.reference_index_entry.text()
+        if reference_index and not os.path.isfile(reference_index):
+            QMessageBox.warning(self, "Warning", f"Reference index {reference_index} does not exist.")
+            return
+        try:
+            modified_from = search_criteria_tab.get_modified_from()
+            modified_until = search_criteria_tab.get_modified_until()
+        except ValueError:
+            QMessageBox.warning(self, "Warning", "Write the modified dates as YYYY-MM-DD.")
+            return
         search_criteria = {
-            'min_file_size': self.search_criteria_tab.get_min_file_size(),
-            'max_file_size': self.search_criteria_tab.get_max_file_size(),
-            'file_extensions': self.search_criteria_tab.get_file_extensions(),
-            'skip_extensions': self.search_criteria_tab.get_skip_extensions(),
-            'search_inside_zip': self.search_criteria_tab.search_inside_zip_checkbox.isChecked()  # Add this line
+            'min_file_size': search_criteria_tab.get_min_file_size(),
+            'max_file_size': search_criteria_tab.get_max_file_size(),
+            'modified_from': modified_from,
+            'modified_until': modified_until,
+            'file_extensions': search_criteria_tab.get_file_extensions(),
+            'skip_extensions': search_criteria_tab.get_skip_extensions(),
+            'search_inside_zip': search_criteria_tab.search_inside_zip_checkbox.isChecked(),  # Add this line
+            'sample_block_size': search_criteria_tab.get_sample_block_size(),
+            'sample_blocks': search_criteria_tab.get_sample_blocks(),
+            'hash_workers': search_criteria_tab.get_hash_workers(),
+            'per_device_workers': search_criteria_tab.get_per_device_workers(),
+            'use_processes': search_criteria_tab.use_processes_checkbox.isChecked(),
+            'hash_algorithm': search_criteria_tab.get_hash_algorithm(),
+            'hash_block_size': search_criteria_tab.get_hash_block_size(),
+            'hash_io': search_criteria_tab.get_hash_io(),
+            'reference_index': reference_index or None,
+            'match_mode': search_criteria_tab.get_match_mode(),
+            'percent_similar': search_criteria_tab.get_percent_similar(),
+            'image_hash': search_criteria_tab.image_hash_combo.currentData(),
+            'image_distance': search_criteria_tab.get_image_distance(),
+            'metadata_keys': search_criteria_tab.get_metadata_keys(),
+            'date_tolerance': search_criteria_tab.get_date_tolerance()
         }
+        if search_criteria['match_mode'] == 'images' and not pillow_available():
+            QMessageBox.warning(self, "Warning", "Searching for similar images needs Pillow. Install it with: pip install Pillow")
+            return
+        if search_criteria['match_mode'] == 'metadata' and not search_criteria['metadata_keys']:
+            QMessageBox.warning(self, "Warning", "Tick at least one file detail to match on.")
+            return
 
         # Pass the fetched directories to the thread
-        self.thread = DuplicatesFinderThread(directories, search_criteria, self.get_hash)
+        self.thread = DuplicatesFinderThread(directories, search_criteria, self.hash_cache)
         self.thread.progress_signal.connect(self.update_progress_bar)
+        self.thread.stats_signal.connect(self.on_search_stats)
+        self.thread.groups_signal.connect(self.on_groups_found)
         self.thread.finished_signal.connect(self.on_search_complete)
+        self.thread.error_signal.connect(self.on_search_error)
+        self.groups_timer.stop()
+        self.pending_groups = []
+        self.model.set_store(DuplicateIndex())
+        self.update_file_counts()
         self.thread.start()
 
+        self.progress_label.setText("Searching...")
         self.progress_label.show()  # Initially show the "Searching..." label
+        self.progress.setRange(0, 0)
+        self.progress.show()
         self.flashing_timer.start()  # Start flashing when search starts
-
-        self.tree.sortByColumn(0, Qt.AscendingOrder)
     
-    def update_progress_bar(self, value):
-        self.progress.setValue(value)
+    def update_progress_bar(self, progress):
+        # Real progress replaces the flashing "Searching..." label
+        self.flashing_timer.stop()
+        self.progress_label.show()
+        self.progress_label.setText(format_progress(progress))
+        # Every stage that reads files (sampling, hashing, fingerprinting, chunking) knows its total bytes
+        if progress['bytes_planned']:
+            self.progress.setRange(0, 1000)
+            self.progress.setValue(int(progress['percent'] * 10))
+        else:
+            self.progress.setRange(0, 0)  # Busy indicator while folders are listed
+        self.progress.show()
+
+    def on_search_stats(self, stats):
+        # Show how many files each stage of the search removed
+        self.scan_stats_label.setText(
+            f"Files seen: {stats['files_seen']}, "
+            f"removed by filters: {stats['filtered_out']}, "
+            f"removed by unique size: {stats['unique_size']}, "
+            f"ZIP members removed by CRC: {stats['unique_crc']}, "
+            f"removed as same folder only: {stats['single_root']}, "
+            f"found in reference index: {stats['reference_matches']}, "
+            f"removed by sample: {stats['unique_sample']} ({stats['bytes_avoided'] / (1024 * 1024):.2f} MB not read), "
+            f"removed by unique hash: {stats['unique_hash']}, "
+            f"cached hashes used: {stats['cache_hits']}, "
+            f"hardlinks merged: {stats['hardlinks_collapsed']}, "
+            f"errors: {stats['errors']}"
+            + (f", hash: {stats['algorithm']}" if 'algorithm' in stats else "")
+            + (", matched on file details only (unverified)" if stats.get('unverified') else "")
+            + (f", block-level deduplication would save {stats['block_dedupe_bytes'] / (1024 * 1024):.2f} MB"
+               f" of {stats['chunked_bytes'] / (1024 * 1024):.2f} MB" if stats.get('chunked_bytes') else ""))
+        # The space to be freed comes from the results, see update_file_counts
 
     def on_search_complete(self, duplicates):
-        # Update the GUI based on the results
-        self.tree.clear()
+        if self.thread.hash_engine is not None:
+            self.hash_engine = self.thread.hash_engine
 
+        # The groups came in batches during the search, only the last ones are left to show
+        self.show_pending_groups()
         if not duplicates:
             QMessageBox.information(self, "Info", "No duplicate files found.")
-        else:
-             for i, files in enumerate(duplicates, start=1):
-                for file in files:
-                    if "_inside_zip" in file:
-                        # Extract the ZIP path and the file inside the ZIP
-                        zip_path, inner_file = file.split("_inside_zip/")
-                        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                            file_size = "{:.1f}".format(zip_ref.getinfo(inner_file).file_size / 1024)  # Get file size in KB from ZIP metadata
-                    else:
-                        file_size = "{:.1f}".format(os.path.getsize(file) / 1024)  # Get file size in KB for regular files
-
-                    filename = os.path.basename(file)
-                    folder_path = os.path.dirname(file)
-                    item = NumericTreeWidgetItem(self.tree)
-                    item.setTextAlignment(3, Qt.AlignRight)
-                    item.setText(0, filename)
-                    #item.setText(1, str(i))
-                    item.setData(1, Qt.DisplayRole, i)
-                    item.setText(2, folder_path)
-                    item.setText(3, file_size)
-                    self.update_file_counts()
-     
-        # Calculate the space that would be freed
-        space_to_free = 0
-        for files in duplicates:
-            for file in files[:-1]:
-                if "_inside_zip" in file:
-                    zip_path, inner_file = file.split("_inside_zip/")
-                    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                        space_to_free += zip_ref.getinfo(inner_file).file_size
-                else:
-                    space_to_free += os.path.getsize(file)
-
-
-        # Convert space_t   o_free from bytes to more readable units (like MB or GB)
-        space_to_free_MB = space_to_free / (1024 * 1024)  # Convert to MB
-
-        # Update the label with the calculated space
-        self.space_to_free_label.setText(f"Space to be freed: {space_to_free_MB:.2f} MB")
-     
+        self.update_file_counts()
+
         self.progress.hide()
         self.find_button.setText("Find Duplicate Files")
         self.flashing_timer.stop()  # Stop flashing when search ends
         self.progress_label.hide()  # Optionally hide the label after search ends
-        self.tree.sortByColumn(1, Qt.AscendingOrder)
-    def compute_duplicates(self, directories):
-        file_dict = {}
-        hashes = {}
-        print("Hashes computed:", hashes)
-        
-        for directory in directories:
-            for foldername, subfolders, filenames in os.walk(directory):
-                for filename in filenames:
-                    path = os.path.join(foldername, filename)
-                    file_dict[path] = self.get_hash(path)
-
-        for file, hash in file_dict.items():
-            if hash not in hashes:
-                hashes[hash] = []
-            hashes[hash].append(file)
-        self.hashes = hashes
-        return hashes
-        
-        print("Self.hashes:", self.hashes)
+
+    def on_search_error(self, message):
+        self.show_pending_groups()
+        self.progress.hide()
+        self.flashing_timer.stop()
+        self.progress_label.hide()
+        QMessageBox.critical(self, "Error", f"The search stopped: {message}")
+
+    def on_groups_found(self, groups):
+        # Each batch added makes the view lay out every group shown again, so batches are
+        # held back longer as the results grow, about 1 second per 10000 groups
+        self.pending_groups.extend(groups)
+        if not self.groups_timer.isActive():
+            self.groups_timer.start(min(self.model.store.group_count() // 10, MAX_GROUPS_DELAY))
+
+    def show_pending_groups(self):
+        self.groups_timer.stop()
+        groups, self.pending_groups = self.pending_groups, []
+        if groups:
+            self.show_groups(groups)
+
+    def show_groups(self, groups):
+        # New groups go after the ones already shown, so what is being reviewed doesn't move
+        first = len(self.model.group_order)
+        self.model.append_groups(groups)
+        if self.model.store.group_count() <= EXPAND_GROUPS_LIMIT:
+            for position in range(first, len(self.model.group_order)):
+                self.tree.expand(self.model.index(position, 0))
+        self.update_file_counts()
 
     def clear_treeview(self):
-        self.tree.clear()
+        self.groups_timer.stop()
+        self.pending_groups = []
+        self.model.set_store(DuplicateIndex())
         self.update_file_counts()
 
     def deselect_all(self):
         self.tree.clearSelection()
+        self.select_rows([])
+
     def delete_selected(self):
 
         print("Delete Selected button clicked")
-        print("Self.hashes before deletion:", self.hashes)
 
-        selected_items = self.tree.selectedItems()
-        selected_count = len(selected_items)
+        selected_rows = self.selected_file_rows()
+        selected_count = len(selected_rows)
 
         if selected_count == 0:
             print("No items selected for deletion.")
             return
 
-        selected_option_id = self.delete_options_tab.button_group.checkedId()
+        selected_option_id = self.delete_options_tab.widget().button_group.checkedId()
         print(f"Selected option ID: {selected_option_id}")
+        if not self.confirm_unmatched_groups(selected_rows, selected_option_id):
+            return
 
-        # Loop through selected items and delete files  
-        for item in selected_items:
-            
-            file_path = os.path.join(item.text(2), item.text(0))
-
+        items = self.plan_actions(selected_rows, selected_option_id)
+        if items:
+            self.start_batch(BatchJournal.create(items))
+
+    def confirm_unmatched_groups(self, selected_rows, selected_option_id):
+        """Check the selection before acting on groups whose files were never found to be identical.
+
+        Linking files that differ would lose one of them, so hardlinks and reflinks are
+        refused. Deleting asks first, with a list of those groups.
+        """
+        store = self.model.store
+        group_ids = sorted({store.group_ids[row] for row in selected_rows if not store.identical(store.group_ids[row])})
+        if not group_ids or selected_option_id == 3:
+            return True  # Moving files loses nothing
+        if selected_option_id in (4, 5):
+            QMessageBox.warning(self, "Warning",
+                                f"{len(group_ids)} of the selected groups were matched by similarity or by file details, "
+                                f"not by identical content, so their files can't be linked. Use Verify Selected Groups "
+                                f"by Hash on groups matched by file details first.")
+            return False
+        lines = []
+        for group_id in group_ids[:20]:
+            kind = "unverified" if group_id in store.unverified else "similar"
+            lines.append(f"Group {group_id} ({kind}): " + ", ".join(store.filename(row) for row in store.group_rows[group_id][:3]))
+        if len(group_ids) > 20:
+            lines.append(f"... and {len(group_ids) - 20} more")
+        answer = QMessageBox.question(self, "Confirm",
+                                      f"The files of {len(group_ids)} of the selected groups were never compared byte for byte:\n\n"
+                                      + "\n".join(lines) + "\n\nDelete the selected files in these groups anyway?")
+        return answer == QMessageBox.Yes
+
+    def plan_actions(self, selected_rows, selected_option_id):
+        """List the (action, path, target) that carry out a delete option on the selected files."""
+        store = self.model.store
+        action = {1: 'delete', 2: 'trash', 3: 'move', 4: 'hardlink', 5: 'reflink'}[selected_option_id]
+        new_folder = None
+        if action == 'move':
+            new_folder = self.delete_options_tab.widget().new_folder_entry.text()
+            if not new_folder:
+                QMessageBox.critical(self, "Error", "No folder specified")
+                return []
+
+        selected = set(selected_rows)
+        items = []
+        zip_members = {}
+        reflink_groups = {}
+        for row in selected_rows:
+            file_path = store.path(row)
             if "_inside_zip" in file_path:
-                self.delete_file_from_zip(file_path) 
+                # Members are collected per archive so each archive is rewritten once
+                zip_path, inner_file = file_path.split("_inside_zip/", 1)
+                zip_members.setdefault(zip_path, []).append(inner_file)
+            elif action == 'hardlink':
+                # The first file of the group that isn't selected is kept, the selected one becomes a link to it
+                group = store.group_rows.get(store.group_ids[row], [])
+                primary_rows = [group_row for group_row in group if group_row not in selected and "_inside_zip" not in store.path(group_row)]
+                if primary_rows:
+                    items.append(('hardlink', file_path, store.path(primary_rows[0])))
+            elif action == 'reflink':
+                # One item per group, the kernel shares the data of the kept file with all the selected ones at once
+                reflink_groups.setdefault(store.group_ids[row], []).append(file_path)
             else:
-                if selected_option_id == 1:
-                    self.delete_file_permanently(file_path)
-                elif selected_option_id == 2:
-                    self.move_file_to_trash(file_path)
-                elif selected_option_id == 3:
-                    self.move_file_to_new_folder(file_path, item)
-                elif selected_option_id == 4:
-                    self.replace_file_with_hardlink(file_path, item)
-
-        self.check_remaining_files()
-        self.update_file_counts()
-        self.tree.sortByColumn(1, Qt.AscendingOrder)
-
-
-    def delete_file_from_zip(self, file_path):
-        zip_path, inner_file = file_path.split("_inside_zip/")
-        try:
-            subprocess.run([r'C:\Program Files\7-Zip\7z.exe', 'd', zip_path, inner_file], check=True)
-        except (PermissionError, subprocess.CalledProcessError, FileNotFoundError, Exception) as e:
-            self.handle_deletion_error(e, file_path)
-        else:
-            # Adding logging here
-            #deleted_id = item.text(1)  # get id from deleted item
-            print(f"Deleted file from ZIP with ID: {deleted_id}")
-            if deleted_id in self.hashes:
-                print(f"Paths associated with this ID before removal: {self.hashes[deleted_id]}")
-            else:
-                print(f"Hash {deleted_id} not found in records.")
-            self.remove_item_from_tree(item)
-
-
-    def delete_file_permanently(self, file_path):
-        try:
-            os.remove(file_path)
-        except OSError as e:
-            self.handle_delete_error(e, file_path)
-      
-        # Update hash lookup
-        hash = get_hash(file_path) 
-        self.files_by_hash[hash].remove(file_path)
-
-        if len(self.files_by_hash[hash]) == 1:
-            # No longer duplicate, remove hash
-            del self.files_by_hash[hash]
+                # The file's other hardlinks go with it, otherwise no space is freed
+                for path in store.all_paths(row):
+                    target = os.path.join(new_folder, os.path.basename(path)) if new_folder else None
+                    items.append((action, path, target))
+        for group_id, targets in reflink_groups.items():
+            primary_rows = [group_row for group_row in store.group_rows.get(group_id, [])
+                            if group_row not in selected and "_inside_zip" not in store.path(group_row)]
+            if primary_rows:
+                items.append(('reflink', store.path(primary_rows[0]), {'targets': targets}))
+        seven_zip = self.delete_options_tab.widget().seven_zip_entry.text() or None
+        for zip_path, members in zip_members.items():
+            items.append(('zip_delete', zip_path, {'members': members, 'seven_zip': seven_zip}))
+        return items
+
+    def start_batch(self, journal, undo=False):
+        # The actions run in the background and every outcome is written to the journal,
+        # so a batch cut short by a crash can be resumed
+        self.batch_thread = BatchThread(journal, undo)
+        self.batch_thread.progress_signal.connect(self.update_batch_progress)
+        self.batch_thread.finished_signal.connect(self.on_batch_complete)
+        for button in (self.delete_button, self.resume_button, self.undo_button):
+            button.setEnabled(False)
+        self.progress.setRange(0, max(len(journal.items), 1))
+        self.progress.setValue(0)
+        self.progress.show()
+        self.progress_label.setText("Undoing..." if undo else "Working...")
+        self.progress_label.show()
+        self.batch_thread.start()
+
+    def update_batch_progress(self, finished, total):
+        self.progress.setRange(0, max(total, 1))
+        self.progress.setValue(finished)
+        self.progress_label.setText(f"{finished} of {total} files")
+
+    def on_batch_complete(self, journal, succeeded, errors):
+        for button in (self.delete_button, self.resume_button, self.undo_button):
+            button.setEnabled(True)
+        self.progress.hide()
+        self.progress_label.hide()
 
-    def move_file_to_trash(self, file_path, item):
-        try:
-            send2trash.send2trash(file_path)
-        except Exception as e:
-            self.handle_deletion_error(e, file_path)
+        if not self.batch_thread.undo:
+            # A file leaves the results once every action on it (its hardlinks included) worked
+            store = self.model.store
+            failed = [number for number, status in journal.status.items() if status == 'error']
+            failed_rows = {store.path_rows.get(path) for number in failed for path in item_paths(journal.items[number])}
+            done_rows = {store.path_rows.get(path) for number in succeeded for path in item_paths(journal.items[number])}
+            self.tree.clearSelection()
+            self.model.remove_rows([row for row in done_rows - failed_rows if row is not None])
+            self.update_file_counts()
+
+        # One summary instead of a message box per file
+        verb = "Restored" if self.batch_thread.undo else "Processed"
+        message = f"{verb} {sum(len(item_paths(journal.items[number])) for number in succeeded)} files."
+        if self.batch_thread.undo and succeeded:
+            message += " Search again to see them in the results."
+        shared = [journal.results[number] for number in succeeded if journal.items[number][0] == 'reflink' and number in journal.results]
+        if shared:
+            shared_MB = sum(sum(result.values()) for result in shared) / (1024 * 1024)
+            message += f" {shared_MB:.2f} MB of data is now shared between copies."
+        if errors:
+            message += f"\n\n{len(errors)} files failed:\n" + "\n".join(f"{path}: {error}" for path, error in errors[:20])
+            if len(errors) > 20:
+                message += f"\n... and {len(errors) - 20} more, see {journal.path}"
+            QMessageBox.warning(self, "Finished with errors", message)
         else:
-            self.remove_item_from_tree(item)
+            QMessageBox.information(self, "Info", message)
 
-    def move_file_to_new_folder(self, file_path, item):
-        new_folder = self.delete_options_tab.new_folder_entry.text()
-        if not new_folder:
-            QMessageBox.critical(self, "Error", "No folder specified")
+    def resume_batch(self):
+        journals = unfinished_journals()
+        if not journals:
+            QMessageBox.information(self, "Info", "No unfinished actions to resume.")
             return
-        os.makedirs(new_folder, exist_ok=True)
-        try:
-            os.rename(file_path, os.path.join(new_folder, item.text(0)))
-        except OSError as e:
-            self.handle_deletion_error(e, file_path)
-        else:
-            self.remove_item_from_tree(item)
-
-    def replace_file_with_hardlink(self, file_path, item):
-        selected_paths = [os.path.join(item.text(2), item.text(0)) for item in self.tree.selectedItems()]
-        
-        for group in self.hashes.values():
-            if len(group) < 2:
-                continue
-            
-            primary_file = group[0]
-            if primary_file in selected_paths:
+        journal = BatchJournal(journals[0])
+        answer = QMessageBox.question(self, "Resume", f"{len(journal.pending())} actions of an earlier batch never ran. Run them now?")
+        if answer == QMessageBox.Yes:
+            self.start_batch(journal)
+
+    def undo_batch(self):
+        path = latest_undoable_journal()
+        if path is None:
+            QMessageBox.information(self, "Info", "No moves or hardlinks to undo. Deleted files can't be brought back.")
+            return
+        journal = BatchJournal(path)
+        answer = QMessageBox.question(self, "Undo", f"Undo {len(journal.undoable())} moves and hardlinks of the last batch?")
+        if answer == QMessageBox.Yes:
+            self.start_batch(journal, undo=True)
+
+    def selected_group_ids(self):
+        """Ids of the groups with a highlighted group row, a highlighted file or a ticked file."""
+        group_ids = {self.model.store.group_ids[row]: True for row in sorted(self.model.checked)}
+        for selection_range in self.tree.selectionModel().selection():
+            parent = selection_range.parent()
+            if parent.isValid():
+                group_ids[self.model.group_order[parent.row()]] = True
+            else:
+                for position in range(selection_range.top(), selection_range.bottom() + 1):
+                    group_ids[self.model.group_order[position]] = True
+        return list(group_ids)
+
+    def verify_selected_groups(self):
+        # Hash the files of the selected groups and replace them with the groups of identical files
+        store = self.model.store
+        group_ids = [group_id for group_id in self.selected_group_ids() if group_id in store.unverified]
+        if not group_ids:
+            QMessageBox.information(self, "Info", "Select groups marked (unverified) to check them by hash.")
+            return
+        groups = [store.group(group_id) for group_id in group_ids]
+        self.verify_thread = VerifyThread(group_ids, groups, self.hash_engine, self.hash_cache)
+        self.verify_thread.progress_signal.connect(self.update_verify_progress)
+        self.verify_thread.finished_signal.connect(self.on_verify_complete)
+        self.verify_button.setEnabled(False)
+        self.progress.setRange(0, max(sum(len(group.members) for group in groups), 1))
+        self.progress.setValue(0)
+        self.progress.show()
+        self.progress_label.setText("Verifying...")
+        self.progress_label.show()
+        self.verify_thread.start()
+
+    def update_verify_progress(self, finished, total):
+        self.progress.setRange(0, max(total, 1))
+        self.progress.setValue(finished)
+        self.progress_label.setText(f"Verifying: {finished} of {total} files hashed")
+
+    def on_verify_complete(self, group_ids, verified):
+        self.verify_button.setEnabled(True)
+        self.progress.hide()
+        self.progress_label.hide()
+        store = self.model.store
+        checked_files = sum(len(store.group_rows.get(group_id, [])) for group_id in group_ids)
+        self.tree.clearSelection()
+        self.model.remove_rows([row for group_id in group_ids for row in list(store.group_rows.get(group_id, []))])
+        if verified:
+            self.show_groups(verified)
+        self.update_file_counts()
+        identical_files = sum(len(group.members) for group in verified)
+        QMessageBox.information(self, "Info", f"Checked {checked_files} files in {len(group_ids)} groups: "
+                                              f"{identical_files} files in {len(verified)} groups are identical, "
+                                              f"the others were removed from the results.")
+
+    def selected_file_rows(self):
+        """Store rows of the files to act on: the ticked files, or the highlighted ones when none are ticked."""
+        if self.model.checked:
+            return sorted(self.model.checked)
+        return self.highlighted_file_rows()
+
+    def highlighted_file_rows(self):
+        """Store rows of the highlighted files, group rows are ignored."""
+        # Read from the selection ranges, selectedRows() gets very slow with thousands of ranges
+        rows = {}
+        for selection_range in self.tree.selectionModel().selection():
+            parent = selection_range.parent()
+            if not parent.isValid():
                 continue
-            
-            for duplicate_file in group[1:]:
-                if duplicate_file not in selected_paths:
-                    continue
-                    
-                try:
-                    os.remove(duplicate_file)  # Remove the duplicate
-                    os.link(primary_file, duplicate_file)  # Create a hardlink from primary to duplicate's location
-                except OSError as e:
-                    QMessageBox.critical(self, "Error", f"Could not replace {duplicate_file} with a hardlink to {primary_file}: {str(e)}")
-                else:
-                    self.remove_item_from_tree(item)
-                    print(f"Replaced {duplicate_file} with a hardlink to {primary_file}")
-
-    def handle_deletion_error(self, error, file_path):
-        QMessageBox.critical(self, "Error", f"Could not process {file_path}: {str(error)}")
-
-    def remove_item_from_tree(self, item):
-        index = self.tree.indexOfTopLevelItem(item)
-        self.tree.takeTopLevelItem(index)
+            group_rows = self.model.store.group_rows[self.model.group_order[parent.row()]]
+            for row in group_rows[selection_range.top():selection_range.bottom() + 1]:
+                rows[row] = True
+        return list(rows)
 
+    def select_rows(self, rows):
+        # The files are ticked rather than selected: the view tests every selection range
+        # for every cell it paints, so a selection of thousands of groups took seconds per repaint
+        self.model.set_checked(rows)
+        self.tree.viewport().update()
 
-    
-    def check_remaining_files(self):
-        hashes = {}
-
-        # Recompute hashes for remaining files
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            file_path = os.path.join(item.text(2), item.text(0))  # Get full path of file
-            if os.path.exists(file_path):  # If file still exists
-                file_hash = self.get_hash(file_path)
-                if file_hash not in hashes:
-                    hashes[file_hash] = []
-                hashes[file_hash].append(item)
-
-        # Check for files that are no longer duplicates
-        for hash, items in hashes.items():
-            if len(items) <= 1:  # If file is no longer a duplicate
-                for item in items:
-                    index = self.tree.indexOfTopLevelItem(item)
-                    self.tree.takeTopLevelItem(index)  # Remove item from tree
-                    
     def update_file_counts(self):
-        # Count the total files and duplicate groups
-        total_files = self.tree.topLevelItemCount()
-        duplicate_groups = len(set([self.tree.topLevelItem(i).text(1) for i in range(total_files)]))
+        # The index keeps running totals, nothing is counted here. Space is counted
+        # once per inode, from the blocks it actually uses on disk
+        total_files = self.model.store.file_count
+        duplicate_groups = self.model.store.group_count()
+        space_to_free_MB = self.model.store.reclaimable_bytes / (1024 * 1024)  # Convert to MB
 
         # Update the labels
         self.total_files_label.setText(f"Total files: {total_files}")
         self.duplicate_files_label.setText(f"Duplicate files: {duplicate_groups}")
+        self.space_to_free_label.setText(f"Space to be freed: {space_to_free_MB:.2f} MB")
         
     def move_selected_to_directory(self):
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
         if not directory:
             return
-        selected_items = self.tree.selectedItems()
-        for item in selected_items:
-            file_path = os.path.join(item.text(2), item.text(0))  # Get full path of file
-            try:
-                os.rename(file_path, os.path.join(directory, item.text(0)))  # Move file to directory
-            except OSError as e:
-                QMessageBox.critical(self, "Error", f"Could not move file {file_path}: {str(e)}")
-            else:
-                index = self.tree.indexOfTopLevelItem(item)
-                self.tree.takeTopLevelItem(index)  # Remove item from tree
+        items = []
+        for row in self.selected_file_rows():
+            file_path = self.model.store.path(row)  # Get full path of file
+            items.append(('move', file_path, os.path.join(directory, os.path.basename(file_path))))
+        if items:
+            self.start_batch(BatchJournal.create(items))
 
     def move_selected_to_new_folder(self):
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -462,75 +897,41 @@ class DuplicatesTab(QWidget):
         self.move_selected_to_directory()   
     
     
-    def get_hash(self, file_path, block_size=65536):
-        # Create a hash for the file
-        file_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            for block in iter(lambda: f.read(block_size), b""):
-                file_hash.update(block)
-        return file_hash.hexdigest()
-
-    def update_duplicates(self, deleted_item):
-        print("Self.hashes on update:", self.hashes)
-        deleted_id = deleted_item.text(1) # get id from deleted item
-        print("Deleted ID:", deleted_id)
-        
-        if deleted_id in self.hashes and len(self.hashes[deleted_id]) == 1:
-#        if len(self.hashes[deleted_id]) == 1:
-        # Remove hash and rows with this id
-            self.hashes.pop(deleted_id)  
-            self.remove_id_rows(deleted_id)
-        else:
-        # Recompute as before
-            self.tree.clear()
-            hashes = self.compute_duplicates(self.directories)
-            self.populate_tree(hashes)
-
-    def remove_id_rows(self, id):
-
-      # Find all matching items
-      matches = self.tree.findItems(id, Qt.MatchExactly, 1)
-      
-      # Remove the matching items
-      for item in matches:
-        self.tree.takeTopLevelItem(self.tree.indexOfTopLevelItem(item))
-        
-    def save_selection(self, selected, deselected):
-        print("Rows selected:", [index.row() for index in self.tree.selectionModel().selectedRows()])
-
-    def clear_selection(self, selected, deselected):
-        print("Rows deselected:", [index.row() for index in deselected.indexes()])
-
-    def export_to_excel(self):
-        # Create a new workbook and select active sheet
-        wb = Workbook()
-        ws = wb.active
-
-        # Write headers
-        for col_num, header in enumerate(self.tree.setHeaderLabels(), 1):
-            col_letter = get_column_letter(col_num)
-            ws[f"{col_letter}1"] = header
-            ws[f"{col_letter}1"].font = Font(bold=True)
-
-        # Write data to the sheet
-        for row_num, tree_item in enumerate(self.iterate_tree_items(self.tree), 2):
-            for col_num, data in enumerate(tree_item, 1):
-                ws.cell(row=row_num, column=col_num, value=data)
-
-        # Ask user where to save the Excel file
+    def export_to_file(self):
+        # Ask user where to save the file, the format comes from the chosen file type
+        filters = {"Excel Files (*.xlsx)": 'xlsx', "CSV Files (*.csv)": 'csv', "JSON Lines Files (*.jsonl)": 'jsonl'}
         options = QFileDialog.Options()
-        filePath, _ = QFileDialog.getSaveFileName(self, "Save File", "", "Excel Files (*.xlsx);;All Files (*)", options=options)
-        if filePath:
-            if not filePath.endswith('.xlsx'):
-                filePath += '.xlsx'
-            wb.save(filePath)
-
-    def iterate_tree_items(self, tree):
-        """Yield each item in the QTreeWidget as a list of its data."""
-        root = tree.invisibleRootItem()
-        for i in range(root.childCount()):
-            item = root.child(i)
-            yield [item.text(col) for col in range(item.columnCount())]
+        filePath, selected_filter = QFileDialog.getSaveFileName(self, "Save File", "", ";;".join(filters), options=options)
+        if not filePath:
+            return
+        export_format = filters.get(selected_filter, 'xlsx')
+        if not filePath.endswith('.' + export_format):
+            filePath += '.' + export_format
+
+        # Written from the store in a background thread, so big exports don't freeze the window
+        self.export_thread = ExportThread(self.model.store, filePath, export_format, list(self.model.group_order))
+        self.export_thread.progress_signal.connect(self.update_export_progress)
+        self.export_thread.finished_signal.connect(self.on_export_complete)
+        self.export_button.setEnabled(False)
+        self.progress.setRange(0, max(self.model.store.file_count, 1))
+        self.progress.setValue(0)
+        self.progress.show()
+        self.progress_label.setText("Exporting...")
+        self.progress_label.show()
+        self.export_thread.start()
+
+    def update_export_progress(self, written, total):
+        self.progress.setValue(written)
+        self.progress_label.setText(f"Exporting: {written} of {total} files")
+
+    def on_export_complete(self, file_path, error):
+        self.export_button.setEnabled(True)
+        self.progress.hide()
+        self.progress_label.hide()
+        if error:
+            QMessageBox.critical(self, "Error", f"Could not export to {file_path}: {error}")
+        else:
+            QMessageBox.information(self, "Info", f"Results exported to {file_path}")
 
     def toggle_searching_visibility(self):
         """Toggle the visibility of the 'Searching...' label."""
@@ -566,21 +967,19 @@ class DuplicatesTab(QWidget):
         menu.exec_(self.tree.viewport().mapToGlobal(position))
 
     def select_files_in_same_folder(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
+        selected_rows = self.highlighted_file_rows()
+        if not selected_rows:
             return
-        selected_folder = selected_items[0].text(2)
-        self.tree.clearSelection()
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            if item.text(2) == selected_folder:
-                item.setSelected(True)
+        store = self.model.store
+        selected_folder = store.folder(selected_rows[0])
+        self.select_rows(row for row in store.rows() if store.folder(row) == selected_folder)
 
     def select_files_in_similar_folder(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
+        selected_rows = self.highlighted_file_rows()
+        if not selected_rows:
             return
-        selected_folder = selected_items[0].text(2)
+        store = self.model.store
+        selected_folder = store.folder(selected_rows[0])
         
         dialog = QInputDialog(self)
         dialog.setInputMode(QInputDialog.TextInput)
@@ -593,29 +992,14 @@ class DuplicatesTab(QWidget):
         similar_folder = dialog.textValue()
         
         if ok and similar_folder:
-            self.tree.clearSelection()
-            for i in range(self.tree.topLevelItemCount()):
-                item = self.tree.topLevelItem(i)
-                if similar_folder in item.text(2):
-                    item.setSelected(True)
-
-    def open_file(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
-            return
-        file_path = os.path.join(selected_items[0].text(2), selected_items[0].text(0))  # Get full path of file
-        if sys.platform == "win32":
-            os.startfile(file_path)
-        elif sys.platform == "darwin":
-            subprocess.Popen(["open", file_path])
-        else:
-            subprocess.Popen(["xdg-open", file_path])
+            self.select_rows(row for row in store.rows() if similar_folder in store.folder(row))
 
     def open_file_location(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
+        selected_rows = self.highlighted_file_rows()
+        if not selected_rows:
             return
-        file_location = selected_items[0].text(2)  # Get file location
+        file_location = self.model.store.folder(selected_rows[0])  # Get file location
+        import subprocess
         if sys.platform == "win32":
             os.startfile(file_location)
         elif sys.platform == "darwin":
@@ -624,10 +1008,11 @@ class DuplicatesTab(QWidget):
             subprocess.Popen(["xdg-open", file_location])  
 
     def open_file(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
+        selected_rows = self.highlighted_file_rows()
+        if not selected_rows:
             return
-        file_path = os.path.join(selected_items[0].text(2), selected_items[0].text(0))  # Get full path of file
+        file_path = self.model.store.path(selected_rows[0])  # Get full path of file
+        import subprocess
         if sys.platform == "win32":
             os.startfile(file_path)
         elif sys.platform == "darwin":
@@ -636,36 +1021,27 @@ class DuplicatesTab(QWidget):
             subprocess.Popen(["xdg-open", file_path])
 
     def select_one_file_per_group(self):
-        duplicate_ids = set()
-        self.tree.clearSelection()
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            if item.text(1) not in duplicate_ids:
-                duplicate_ids.add(item.text(1))
-            else:
-                item.setSelected(True)
+        # Select every file but the first one of each group
+        rows = []
+        for group_id in self.model.group_order:
+            rows.extend(self.model.store.group_rows[group_id][1:])
+        self.select_rows(rows)
     
     def select_files_on_same_drive(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
+        selected_rows = self.highlighted_file_rows()
+        if not selected_rows:
             return
-        selected_drive = os.path.splitdrive(selected_items[0].text(2))[0]  # Get the drive of the selected file
-        self.tree.clearSelection()
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            if os.path.splitdrive(item.text(2))[0] == selected_drive:  # If the drive of the file matches the selected drive
-                item.setSelected(True)
+        store = self.model.store
+        selected_drive = os.path.splitdrive(store.folder(selected_rows[0]))[0]  # Get the drive of the selected file
+        self.select_rows(row for row in store.rows() if os.path.splitdrive(store.folder(row))[0] == selected_drive)
 
     def select_files_duplicated_elsewhere(self):
-        selected_items = self.tree.selectedItems()
-        if not selected_items:
+        selected_rows = self.highlighted_file_rows()
+        if not selected_rows:
             return
-        selected_folder = selected_items[0].text(2)  # Get the folder of the selected file
-        self.tree.clearSelection()
-        for i in range(self.tree.topLevelItemCount()):
-            item = self.tree.topLevelItem(i)
-            if item.text(2) != selected_folder:  # If the folder of the file does not match the selected folder
-                item.setSelected(True)
+        store = self.model.store
+        selected_folder = store.folder(selected_rows[0])  # Get the folder of the selected file
+        self.select_rows(row for row in store.rows() if store.folder(row) != selected_folder)
   
   
 class SearchDirectoriesTab(QWidget):
@@ -684,13 +1060,18 @@ class SearchDirectoriesTab(QWidget):
         main_layout.addWidget(self.go_up_button)
 
         # Add a Directory Tree View
+        # Only the folder shown is watched, watching from the file system root makes the model
+        # list and watch the whole drive
+        start_folder = QDir().homePath() + "/Documents"
+        if not os.path.isdir(start_folder):
+            start_folder = QDir().homePath()
         self.file_system_model = QFileSystemModel()
-        self.file_system_model.setRootPath(QDir.rootPath())
+        self.file_system_model.setRootPath(start_folder)
         self.file_system_model.setFilter(QDir.NoDotAndDotDot | QDir.AllDirs)  # To display only directories
 
         self.tree = QTreeView()
         self.tree.setModel(self.file_system_model)
-        self.tree.setRootIndex(self.file_system_model.index(QDir().homePath() + "/Documents"))
+        self.tree.setRootIndex(self.file_system_model.index(start_folder))
         self.tree.doubleClicked.connect(self.add_directory_from_tree)
 
         # Hide the unnecessary columns
@@ -738,6 +1119,7 @@ class SearchDirectoriesTab(QWidget):
         index = self.tree.rootIndex()
         parent_index = index.parent()
         if parent_index.isValid():  # Make sure the parent directory exists
+            self.file_system_model.setRootPath(self.file_system_model.filePath(parent_index))
             self.tree.setRootIndex(parent_index)
 
     def add_directory_from_tree(self, index):
@@ -748,6 +1130,7 @@ class SearchDirectoriesTab(QWidget):
         row = self.table.rowCount()
         self.table.insertRow(row)
         checkbox = QCheckBox()
+        checkbox.setChecked(True)  # Checked by default, unticked the folder's files are only compared with the other folders
         self.table.setCellWidget(row, 0, checkbox)
         self.table.setItem(row, 1, QTableWidgetItem(path))
 
@@ -757,6 +1140,7 @@ class SearchDirectoriesTab(QWidget):
             row = self.table.rowCount()
             self.table.insertRow(row)
             checkbox = QCheckBox()
+            checkbox.setChecked(True)
             self.table.setCellWidget(row, 0, checkbox)
             self.table.setItem(row, 1, QTableWidgetItem(directory))
 
@@ -800,6 +1184,19 @@ class SearchCriteriaTab(QWidget):
         max_file_size_layout.addWidget(self.max_file_size_entry)
         layout.addLayout(max_file_size_layout)
 
+        # Only files last modified between these dates are searched, both days included
+        modified_layout = QHBoxLayout()
+        modified_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        modified_from_label = QLabel("Modified from (YYYY-MM-DD):")
+        modified_layout.addWidget(modified_from_label)
+        self.modified_from_entry = QLineEdit()
+        modified_layout.addWidget(self.modified_from_entry)
+        modified_until_label = QLabel("Modified until (YYYY-MM-DD):")
+        modified_layout.addWidget(modified_until_label)
+        self.modified_until_entry = QLineEdit()
+        modified_layout.addWidget(self.modified_until_entry)
+        layout.addLayout(modified_layout)
+
 
         # File extensions field
         file_extensions_layout = QHBoxLayout()
@@ -819,10 +1216,68 @@ class SearchCriteriaTab(QWidget):
         skip_extensions_layout.addWidget(self.skip_extensions_entry)
         layout.addLayout(skip_extensions_layout)
 
+        # Sample checked before the full hash of same-size files
+        sample_layout = QHBoxLayout()
+        sample_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        sample_block_size_label = QLabel("Quick check block size (KB):")
+        sample_layout.addWidget(sample_block_size_label)
+        self.sample_block_size_entry = QLineEdit(str(SAMPLE_BLOCK_SIZE // 1024))
+        sample_layout.addWidget(self.sample_block_size_entry)
+        sample_blocks_label = QLabel("Quick check blocks per file (0 to disable):")
+        sample_layout.addWidget(sample_blocks_label)
+        self.sample_blocks_entry = QLineEdit(str(SAMPLE_BLOCKS))
+        sample_layout.addWidget(self.sample_blocks_entry)
+        layout.addLayout(sample_layout)
+
+        # Number of files hashed at the same time
+        workers_layout = QHBoxLayout()
+        workers_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        hash_workers_label = QLabel("Hashing workers:")
+        workers_layout.addWidget(hash_workers_label)
+        self.hash_workers_entry = QLineEdit()
+        self.hash_workers_entry.setPlaceholderText(f"automatic ({DEFAULT_HASH_WORKERS})")
+        workers_layout.addWidget(self.hash_workers_entry)
+        per_device_workers_label = QLabel("Workers per disk:")
+        workers_layout.addWidget(per_device_workers_label)
+        self.per_device_workers_entry = QLineEdit()
+        self.per_device_workers_entry.setPlaceholderText("automatic (1 for spinning disks)")
+        workers_layout.addWidget(self.per_device_workers_entry)
+        self.use_processes_checkbox = QCheckBox("Hash in separate processes")
+        workers_layout.addWidget(self.use_processes_checkbox)
+        layout.addLayout(workers_layout)
+
+        # Hash algorithm, "automatic" picks the fastest one on this computer
+        hash_layout = QHBoxLayout()
+        hash_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        hash_algorithm_label = QLabel("Hash algorithm:")
+        hash_layout.addWidget(hash_algorithm_label)
+        self.hash_algorithm_combo = QComboBox()
+        self.hash_algorithm_combo.addItem("automatic (fastest)", "auto")
+        for algorithm in available_hash_algorithms():
+            self.hash_algorithm_combo.addItem(algorithm, algorithm)
+        self.hash_algorithm_combo.setCurrentIndex(self.hash_algorithm_combo.findData(DEFAULT_HASH_ALGORITHM))
+        hash_layout.addWidget(self.hash_algorithm_combo)
+        hash_block_size_label = QLabel("Read block size (KB):")
+        hash_layout.addWidget(hash_block_size_label)
+        self.hash_block_size_entry = QLineEdit(str(DEFAULT_HASH_BLOCK_SIZE // 1024))
+        hash_layout.addWidget(self.hash_block_size_entry)
+        hash_io_label = QLabel("File reading:")
+        hash_layout.addWidget(hash_io_label)
+        self.hash_io_combo = QComboBox()
+        for io_strategy in HASH_IO_STRATEGIES:
+            if io_strategy == 'file_digest' and not hasattr(hashlib, 'file_digest'):
+                continue
+            self.hash_io_combo.addItem(io_strategy, io_strategy)
+        hash_layout.addWidget(self.hash_io_combo)
+        self.benchmark_button = QPushButton("Benchmark")
+        self.benchmark_button.clicked.connect(self.run_hash_benchmark)
+        hash_layout.addWidget(self.benchmark_button)
+        layout.addLayout(hash_layout)
+
         layout.addSpacing(20)
         
         # Checkbox for searching inside ZIP files
-        self.search_inside_zip_checkbox = QCheckBox("Search inside ZIP files [requires 7-zip to delete files within the zip file]")
+        self.search_inside_zip_checkbox = QCheckBox("Search inside ZIP files")
         self.search_inside_zip_checkbox.setChecked(True)  # Set the default state to checked
 
         # QHBoxLayout for indenting the checkbox
@@ -833,26 +1288,97 @@ class SearchCriteriaTab(QWidget):
 
         layout.addLayout(zip_search_layout)  # Add the QHBoxLayout to the main layout
 
+        # Saved index of a library, the folders are checked against it instead of rescanning the library
+        reference_layout = QHBoxLayout()
+        reference_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        reference_label = QLabel("Reference index (optional):")
+        reference_layout.addWidget(reference_label)
+        self.reference_index_entry = QLineEdit()
+        self.reference_index_entry.setPlaceholderText("built with: python DuplicateFinderEngine.py --build-index INDEX FOLDER...")
+        reference_layout.addWidget(self.reference_index_entry)
+        self.reference_index_button = QPushButton("Browse")
+        self.reference_index_button.clicked.connect(self.select_reference_index)
+        reference_layout.addWidget(self.reference_index_button)
+        layout.addLayout(reference_layout)
+
 
 
         # Space between radio buttons
         layout.addSpacing(50)
 
+        # How files are matched, identical content or content that is mostly the same
+        match_mode_layout = QHBoxLayout()
+        match_mode_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        match_mode_label = QLabel("Match files by:")
+        match_mode_layout.addWidget(match_mode_label)
+        self.match_mode_combo = QComboBox()
+        self.match_mode_combo.addItem("Identical content (hash)", 'hash')
+        self.match_mode_combo.addItem("Similar content (shared chunks)", 'similar')
+        self.match_mode_combo.addItem("Shared byte ranges (chunk index, slower)", 'blocks')
+        self.match_mode_combo.addItem("Similar images (perceptual hash, needs Pillow)", 'images')
+        self.match_mode_combo.addItem("File details only (no hashing, unverified)", 'metadata')
+        self.match_mode_combo.currentIndexChanged.connect(self.update_match_mode)
+        match_mode_layout.addWidget(self.match_mode_combo)
+        match_mode_layout.addStretch()
+        layout.addLayout(match_mode_layout)
+
         percent_similar_layout = QHBoxLayout()
         percent_similar_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))  # Add a spacer item
-        percent_similar_label = QLabel("Percent Similar (in progress, not currently working):")
+        percent_similar_label = QLabel("Percent Similar:")
         percent_similar_layout.addWidget(percent_similar_label)
-        self.percent_similar_entry = QLineEdit()
-        self.percent_similar_entry.setEnabled(False)  # Disable the input field until the feature is implemented
+        self.percent_similar_entry = QLineEdit("90")
+        self.percent_similar_entry.setEnabled(False)  # Only used when matching similar files
         percent_similar_layout.addWidget(self.percent_similar_entry)
         layout.addLayout(percent_similar_layout)
 
+        # Similar images are matched by how many bits of their 64 bit hashes differ
+        image_layout = QHBoxLayout()
+        image_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        image_hash_label = QLabel("Image hash:")
+        image_layout.addWidget(image_hash_label)
+        self.image_hash_combo = QComboBox()
+        for method in IMAGE_HASHES:
+            self.image_hash_combo.addItem(method, method)
+        self.image_hash_combo.setCurrentIndex(self.image_hash_combo.findData(DEFAULT_IMAGE_HASH))
+        image_layout.addWidget(self.image_hash_combo)
+        image_distance_label = QLabel("Max difference (bits of 64):")
+        image_layout.addWidget(image_distance_label)
+        self.image_distance_entry = QLineEdit(str(DEFAULT_IMAGE_DISTANCE))
+        image_layout.addWidget(self.image_distance_entry)
+        layout.addLayout(image_layout)
+        self.image_hash_combo.setEnabled(False)
+        self.image_distance_entry.setEnabled(False)
+
+        # File details to match on when no file is read, dates match within the tolerance
+        metadata_layout = QHBoxLayout()
+        metadata_layout.addItem(QSpacerItem(40, 20, QSizePolicy.Fixed, QSizePolicy.Fixed))
+        metadata_label = QLabel("Match on:")
+        metadata_layout.addWidget(metadata_label)
+        self.metadata_checkboxes = {}
+        for key, text in (('size', "Size"), ('name', "Name"), ('mtime', "Modified date"), ('ctime', "Created date")):
+            checkbox = QCheckBox(text)
+            checkbox.setChecked(key in ('size', 'name'))
+            checkbox.setEnabled(False)
+            metadata_layout.addWidget(checkbox)
+            self.metadata_checkboxes[key] = checkbox
+        date_tolerance_label = QLabel("Date tolerance (seconds):")
+        metadata_layout.addWidget(date_tolerance_label)
+        self.date_tolerance_entry = QLineEdit(str(DEFAULT_DATE_TOLERANCE))
+        self.date_tolerance_entry.setEnabled(False)
+        metadata_layout.addWidget(self.date_tolerance_entry)
+        layout.addLayout(metadata_layout)
+
         # Add a spacer to push the contents to the top
         layout.addItem(QSpacerItem(20, 40, QSizePolicy.Minimum, QSizePolicy.Expanding))
 
         self.setLayout(layout)
 
 
+    def select_reference_index(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Reference Index", "", "Reference Index (*.sqlite3);;All Files (*)")
+        if file_path:
+            self.reference_index_entry.setText(file_path)
+
     def get_min_file_size(self):
         # Return the entered minimum file size in KB, or 0 if no size is entered
         return int(self.min_file_size_entry.text()) if self.min_file_size_entry.text().isdigit() else 0
@@ -861,6 +1387,14 @@ class SearchCriteriaTab(QWidget):
         # Return the entered maximum file size in KB, or sys.maxsize if no size is entered
         return int(self.max_file_size_entry.text()) if self.max_file_size_entry.text().isdigit() else sys.maxsize
 
+    def get_modified_from(self):
+        # Return the start of the entered day in nanoseconds, or None if no date is entered
+        return parse_date(self.modified_from_entry.text()) if self.modified_from_entry.text().strip() else None
+
+    def get_modified_until(self):
+        # Return the end of the entered day in nanoseconds, or None if no date is entered
+        return parse_date(self.modified_until_entry.text(), end_of_day=True) if self.modified_until_entry.text().strip() else None
+
     def get_file_extensions(self):
         # Return the entered file extensions as a list, or an empty list if no extensions are entered
         return [ext.strip() for ext in self.file_extensions_entry.text().split(",")] if self.file_extensions_entry.text() else []
@@ -869,14 +1403,99 @@ class SearchCriteriaTab(QWidget):
         # Return the entered skip extensions as a list, or an empty list if no extensions are entered
         return [ext.strip() for ext in self.skip_extensions_entry.text().split(",")] if self.skip_extensions_entry.text() else []
     
+    def get_sample_block_size(self):
+        # Return the quick check block size in bytes, or the default if no size is entered
+        return int(self.sample_block_size_entry.text()) * 1024 if self.sample_block_size_entry.text().isdigit() and int(self.sample_block_size_entry.text()) > 0 else SAMPLE_BLOCK_SIZE
+
+    def get_sample_blocks(self):
+        # Return the number of quick check blocks, or the default if no number is entered
+        return int(self.sample_blocks_entry.text()) if self.sample_blocks_entry.text().isdigit() else SAMPLE_BLOCKS
+
+    def get_hash_workers(self):
+        # Return the entered number of hashing workers, or None to pick it automatically
+        return int(self.hash_workers_entry.text()) if self.hash_workers_entry.text().isdigit() and int(self.hash_workers_entry.text()) > 0 else None
+
+    def get_per_device_workers(self):
+        # Return the entered number of workers per disk, or None to pick it automatically
+        return int(self.per_device_workers_entry.text()) if self.per_device_workers_entry.text().isdigit() and int(self.per_device_workers_entry.text()) > 0 else None
+
+    def get_hash_algorithm(self):
+        return self.hash_algorithm_combo.currentData()
+
+    def get_hash_block_size(self):
+        # Return the read block size in bytes, or the default if no size is entered
+        return int(self.hash_block_size_entry.text()) * 1024 if self.hash_block_size_entry.text().isdigit() and int(self.hash_block_size_entry.text()) > 0 else DEFAULT_HASH_BLOCK_SIZE
+
+    def get_hash_io(self):
+        return self.hash_io_combo.currentData()
+
+    def run_hash_benchmark(self):
+        # The benchmark writes and reads a large temporary file, so it runs in the background
+        self.benchmark_thread = BenchmarkThread(self.get_hash_block_size())
+        self.benchmark_thread.finished_signal.connect(self.on_benchmark_complete)
+        self.benchmark_button.setEnabled(False)
+        self.benchmark_button.setText("Benchmarking...")
+        self.benchmark_thread.start()
+
+    def on_benchmark_complete(self, results, io_results, error):
+        self.benchmark_button.setEnabled(True)
+        self.benchmark_button.setText("Benchmark")
+        if error:
+            QMessageBox.critical(self, "Error", f"Could not run the benchmark: {error}")
+            return
+        fastest = next(iter(results))
+        self.hash_algorithm_combo.setCurrentIndex(self.hash_algorithm_combo.findData(fastest))
+        lines = [f"{algorithm}: {speed:.0f} MB/s" for algorithm, speed in results.items()]
+        lines.append("")
+        lines.append(f"Reading files with {fastest}:")
+        lines.extend(f"{io_strategy}: {speed:.0f} MB/s, {cpu:.2f} s CPU per GB" for io_strategy, (speed, cpu) in io_results.items())
+        QMessageBox.information(self, "Hash Benchmark", "\n".join(lines))
+
+    def update_match_mode(self):
+        match_mode = self.get_match_mode()
+        self.percent_similar_entry.setEnabled(match_mode in ('similar', 'blocks'))
+        self.image_hash_combo.setEnabled(match_mode == 'images')
+        self.image_distance_entry.setEnabled(match_mode == 'images')
+        for checkbox in self.metadata_checkboxes.values():
+            checkbox.setEnabled(match_mode == 'metadata')
+        self.date_tolerance_entry.setEnabled(match_mode == 'metadata')
+        # Only identical files are looked for inside ZIP files
+        self.search_inside_zip_checkbox.setEnabled(match_mode == 'hash')
+
+    def get_metadata_keys(self):
+        return [key for key, checkbox in self.metadata_checkboxes.items() if checkbox.isChecked()]
+
+    def get_date_tolerance(self):
+        # Return the entered number of seconds, or the default if no valid number is entered
+        text = self.date_tolerance_entry.text()
+        return int(text) if text.isdigit() else DEFAULT_DATE_TOLERANCE
+
+    def get_image_distance(self):
+        # Return the entered number of bits, or the default if no valid number is entered
+        text = self.image_distance_entry.text()
+        return int(text) if text.isdigit() and int(text) <= 64 else DEFAULT_IMAGE_DISTANCE
+
+    def get_match_mode(self):
+        return self.match_mode_combo.currentData()
+
     def get_percent_similar(self):
-        # Placeholder method to be implemented in the future
-        pass
+        # Return the entered percentage from 1 to 100, or 90 if no valid number is entered
+        text = self.percent_similar_entry.text()
+        return int(text) if text.isdigit() and 0 < int(text) <= 100 else 90
         
     def should_search_inside_zip(self):
         """Return True if the user wants to search inside ZIP files, otherwise return False."""
         return self.search_inside_zip_checkbox.isChecked()        
         
+def item_paths(item):
+    """Result paths a batch item acts on, an archive item covers all its members."""
+    action, path, target = item
+    if action == 'zip_delete':
+        return [f"{path}_inside_zip/{member}" for member in target['members']]
+    if action == 'reflink':
+        return target['targets']  # The kept file stays in the results
+    return [path]
+
 class DeleteOptionsTab(QWidget):
     def __init__(self, *args, **kwargs):
         super(DeleteOptionsTab, self).__init__(*args, **kwargs)
@@ -924,6 +1543,18 @@ class DeleteOptionsTab(QWidget):
         # Space between radio buttons
         layout.addSpacing(10)
 
+        # Copy-on-write filesystems can share the data of identical files, every file stays an independent copy
+        self.reflink_radio = QRadioButton("Share data between duplicates (reflink, Linux btrfs/XFS only)")
+        self.button_group.addButton(self.reflink_radio, 5)
+
+        reflink_radio_layout = QHBoxLayout()
+        reflink_radio_layout.addSpacing(40)  # Indent by 20 pixels
+        reflink_radio_layout.addWidget(self.reflink_radio)
+        layout.addLayout(reflink_radio_layout)
+
+        # Space between radio buttons
+        layout.addSpacing(10)
+
         # Combine the radio button and input field in a single horizontal layout
         combined_layout = QHBoxLayout()
         combined_layout.addSpacing(40)  # Indent by 20 pixels
@@ -952,6 +1583,15 @@ class DeleteOptionsTab(QWidget):
         self.new_folder_label = QLabel("Folder for moving/hardlinks:")
         layout.addWidget(self.new_folder_label)
 
+        # Files inside ZIP archives are removed by rewriting the archive, 7-Zip can do it instead
+        seven_zip_layout = QHBoxLayout()
+        seven_zip_layout.addSpacing(40)
+        seven_zip_layout.addWidget(QLabel("7-Zip program for ZIP files (optional):"))
+        self.seven_zip_entry = QLineEdit()
+        self.seven_zip_entry.setPlaceholderText(r"C:\Program Files\7-Zip\7z.exe")
+        seven_zip_layout.addWidget(self.seven_zip_entry)
+        layout.addLayout(seven_zip_layout)
+
     def select_folder(self):
         directory = QFileDialog.getExistingDirectory(self, "Select Directory")
         if directory:  # If a directory is selected
@@ -979,11 +1619,6 @@ This is version {version} and it still a beta level software...<br><br>
 
 The following features are not yet active:
 <div style="font-size:10pt;">
-&nbsp;&nbsp;&nbsp;&nbsp;a) limit scanning of folder against itself<br>
-&nbsp;&nbsp;&nbsp;&nbsp;b) percent similar function - this will allow for scanning for similar files that are not exact matches<br>
-&nbsp;&nbsp;&nbsp;&nbsp;c) limit search by date<br>
-&nbsp;&nbsp;&nbsp;&nbsp;e) limit search by same/similar file names<br>
-&nbsp;&nbsp;&nbsp;&nbsp;f) limit search to same created/modified date<br>
 &nbsp;&nbsp;&nbsp;&nbsp;g) many, many, many more...<br><br><br>
 
 THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
@@ -998,8 +1633,23 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
 
 
+def report_startup_time(import_time, window_time):
+    # Called from the event loop, so the window has been shown and painted once
+    shown_time = time.perf_counter()
+    print(f"Imports: {(import_time - STARTUP_TIME) * 1000:.0f} ms")
+    print(f"Qt and main window built: {(window_time - import_time) * 1000:.0f} ms")
+    print(f"Window shown: {(shown_time - window_time) * 1000:.0f} ms")
+    print(f"Time to first window: {(shown_time - STARTUP_TIME) * 1000:.0f} ms")
+    QApplication.quit()
+
+
 if __name__ == "__main__":
+    import_time = time.perf_counter()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    if "--startup-time" in sys.argv:
+        # Measure how long the program takes to start, then quit
+        window_time = time.perf_counter()
+        QTimer.singleShot(0, lambda: report_startup_time(import_time, window_time))
     sys.exit(app.exec())
@@ -0,0 +1,2681 @@
+"""Search engine of Duplicate File Finder, usable without PyQt5.
+
+The GUI runs DuplicateScanner in a QThread; on its own this module is a command
+line tool, see `python DuplicateFinderEngine.py --help`.
+"""
+import sys
+import os
+import hashlib
+import importlib.util
+import time
+import mmap
+import sqlite3
+import threading
+import collections
+import math
+import re
+import csv
+import json
+import datetime
+from array import array
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Default sample used to split same-size files before the full hash
+SAMPLE_BLOCK_SIZE = 4096
+SAMPLE_BLOCKS = 5
+
+# Confirmed duplicate groups are passed on in batches, at most this often
+GROUP_BATCH_INTERVAL = 0.5
+
+# hashlib releases the GIL while hashing, so threads keep several disks and cores busy
+DEFAULT_HASH_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Directory listings mostly wait on the file system (especially over the network)
+DEFAULT_WALK_WORKERS = 16
+
+def get_config_dir():
+    # Folder for the user's settings and caches
+    if sys.platform == "win32":
+        base = os.environ.get("APPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config"))
+    return os.path.join(base, "DuplicateFileFinder")
+
+
+class DuplicateScanner:
+    """Finds the duplicate files under a list of directories.
+
+    directories is a list of (directory, scan_against_self) and search_criteria
+    the dict the Search Criteria tab builds. Files in a directory that isn't
+    scanned against itself are only compared with files in the other ones.
+    With search_criteria['reference_index'] set to a ReferenceIndex file, the
+    files are also checked against the library in the index, and the library
+    files they match are added to their groups. The optional callbacks get
+    ScanProgress snapshots, the stats dict at the end and batches of
+    DuplicateGroups as soon as they are confirmed. run() returns all the groups.
+
+    search_criteria['match_mode'] picks how files are matched: 'hash' for
+    identical content, 'similar' for files that share at least
+    search_criteria['percent_similar'] percent of their chunks, and 'blocks'
+    for files that have at least that percent of their bytes in common,
+    from an index of every chunk, and 'images' for images that look the same,
+    whose search_criteria['image_hash'] differ by at most
+    search_criteria['image_distance'] bits. 'metadata' never opens a file, it
+    groups on the search_criteria['metadata_keys'] alone and the groups are
+    marked unverified. search_criteria['modified_from'] and ['modified_until']
+    limit every mode to files modified in that range, in nanoseconds from
+    parse_date().
+    """
+
+    def __init__(self, directories, search_criteria, hash_cache=None, on_progress=None, on_stats=None, on_groups=None):
+        self.directories = merge_roots(directories)
+        self.scan_self = [scan_self for directory, scan_self in directories]
+        self.search_criteria = search_criteria
+        self.hash_cache = hash_cache
+        self.hash_engine = None
+        self.on_stats = on_stats
+        self.on_groups = on_groups
+        self.progress = ScanProgress(on_progress)
+        self.pending_groups = []
+        self.last_groups_emit = 0
+
+    def run(self):
+        import zipfile  # Imported here so starting the GUI doesn't load it
+        search_inside_zip = self.search_criteria.get('search_inside_zip', False)
+        # Only identical files are looked for inside archives. The other modes leave the
+        # members out, and listing them would mean reading every archive's directory
+        if self.search_criteria.get('match_mode', 'hash') != 'hash':
+            search_inside_zip = False
+        
+        min_size = self.search_criteria['min_file_size']
+        max_size = self.search_criteria['max_file_size']
+        modified_from = self.search_criteria.get('modified_from')
+        modified_until = self.search_criteria.get('modified_until')
+        allowed_extensions = self.search_criteria.get('file_extensions', set())
+        skip_extensions = set(self.search_criteria.get('skip_extensions', []))
+
+        # Number of files removed at each stage of the search
+        stats = {'files_seen': 0, 'filtered_out': 0, 'unique_size': 0, 'unique_sample': 0, 'unique_hash': 0,
+                 'duplicate_files': 0, 'errors': 0, 'sample_bytes_read': 0, 'bytes_hashed': 0, 'bytes_avoided': 0,
+                 'cache_hits': 0, 'cache_evicted': 0, 'hardlinks_collapsed': 0, 'reclaimable_bytes': 0, 'unique_crc': 0,
+                 'single_root': 0, 'reference_matches': 0,
+                 'chunked_bytes': 0, 'block_dedupe_bytes': 0, 'unverified': False}
+
+        if not self.directories:
+            self.report_stats(stats)
+            return []
+
+        reference = None
+        hash_algorithm = self.search_criteria.get('hash_algorithm', DEFAULT_HASH_ALGORITHM)
+        if self.search_criteria.get('reference_index'):
+            if not os.path.isfile(self.search_criteria['reference_index']):
+                raise FileNotFoundError(f"Reference index {self.search_criteria['reference_index']} does not exist")
+            reference = ReferenceIndex(self.search_criteria['reference_index'], read_only=True)
+            hash_algorithm = reference.algorithm or hash_algorithm
+
+        # Stage 1: group every candidate by its exact size in bytes, no file is read yet
+        def name_filter(filename):
+            file_extension = os.path.splitext(filename)[1][1:].lower()  # Convert to lowercase for consistent checking
+            if allowed_extensions and file_extension not in allowed_extensions:
+                return False
+            return file_extension not in skip_extensions
+
+        progress = self.progress
+        walker = DirectoryWalker(self.search_criteria.get('walk_workers'), name_filter)
+        size_buckets = {}
+        walked = {}  # Every listed file, so the hash cache can be pruned without another stat pass
+        for entry in walker.walk([directory for directory, _ in self.directories]):
+            walked[entry.path] = entry
+            stats['files_seen'] += 1
+            progress.files_seen = stats['files_seen'] + walker.files_skipped
+            progress.directories_walked = walker.directories_walked
+            progress.report()
+            file_size = entry.st_size // 1024  # Get file size in KB
+
+            # Checks before processing
+            if not (min_size <= file_size <= max_size):
+                stats['filtered_out'] += 1
+                continue
+            if ((modified_from is not None and entry.st_mtime_ns < modified_from)
+                    or (modified_until is not None and entry.st_mtime_ns >= modified_until)):
+                stats['filtered_out'] += 1
+                continue
+
+            # Regular file handling
+            size_buckets.setdefault(entry.st_size, []).append(entry)
+
+            # ZIP file handling, the member sizes come from the ZIP directory
+            if search_inside_zip and entry.path.lower().endswith('.zip'):
+                try:
+                    with zipfile.ZipFile(entry.path, 'r') as zip_ref:
+                        for zip_info in zip_ref.infolist():
+                            if zip_info.is_dir():
+                                continue
+                            stats['files_seen'] += 1
+                            member_path = f"{entry.path}_inside_zip/{zip_info.filename}"
+                            # Deleting a member frees its compressed size
+                            member_blocks = (zip_info.compress_size + 511) // 512
+                            size_buckets.setdefault(zip_info.file_size, []).append(ScanEntry(member_path, entry.root, zip_info.file_size, 0, entry.st_dev, 0, 1, member_blocks, zip_info.CRC))
+                except (zipfile.BadZipFile, OSError):
+                    stats['errors'] += 1
+
+        stats['files_seen'] += walker.files_skipped
+        stats['filtered_out'] += walker.files_skipped
+        stats['errors'] += walker.errors
+        progress.files_seen = stats['files_seen']
+        progress.directories_walked = walker.directories_walked
+        progress.candidates['filters'] = stats['files_seen'] - stats['filtered_out']
+
+        # Paths that are hardlinks of the same file are collapsed into one entry, so
+        # each inode is read once and never reported as a duplicate of itself
+        links = {}
+        for size, files in list(size_buckets.items()):
+            if len(files) < 2:
+                continue
+            inodes = {}
+            for entry in files:
+                if "_inside_zip/" not in entry.path and not entry.st_ino:
+                    # Windows directory listings leave out the inode and link count
+                    try:
+                        entry = scan_entry(entry.path, entry.root, os.lstat(entry.path))
+                    except OSError:
+                        stats['errors'] += 1
+                        continue
+                if not entry.st_ino:
+                    inodes[entry.path] = entry
+                elif (entry.st_dev, entry.st_ino) in inodes:
+                    links[inodes[(entry.st_dev, entry.st_ino)].path].append(entry.path)
+                    stats['hardlinks_collapsed'] += 1
+                else:
+                    inodes[(entry.st_dev, entry.st_ino)] = entry
+                    links[entry.path] = [entry.path]
+            size_buckets[size] = list(inodes.values())
+
+        # Made before the modes branch off, so groups matched on metadata are verified with the chosen algorithm
+        hash_engine = HashEngine(hash_algorithm,
+                                 self.search_criteria.get('hash_block_size', DEFAULT_HASH_BLOCK_SIZE),
+                                 self.search_criteria.get('hash_io', 'auto'))
+        self.hash_engine = hash_engine
+
+        if self.search_criteria.get('match_mode', 'hash') in ('similar', 'blocks', 'images', 'metadata'):
+            if self.search_criteria['match_mode'] == 'metadata':
+                duplicates = self.find_by_metadata(size_buckets, links, stats)
+            elif self.search_criteria['match_mode'] == 'similar':
+                duplicates = self.find_similar_files(size_buckets, links, stats)
+            elif self.search_criteria['match_mode'] == 'blocks':
+                duplicates = self.find_shared_blocks(size_buckets, links, stats)
+            else:
+                duplicates = self.find_similar_images(size_buckets, links, stats)
+            progress.start_stage('done')
+            self.emit_groups(force=True)
+            self.report_stats(stats)
+            return duplicates
+
+        # Stage 2: hash a small sample of each same-size file and split the buckets on it
+        sample_block_size = self.search_criteria.get('sample_block_size', SAMPLE_BLOCK_SIZE)
+        sample_blocks = self.search_criteria.get('sample_blocks', SAMPLE_BLOCKS)
+        stats['algorithm'] = hash_engine.name
+        pool = self.make_pool()
+        sample_buckets = []
+        sample_jobs = []
+        reference_sizes = set()
+        for size, files in size_buckets.items():
+            # The index is asked about sizes first, so only files a library file could match get hashed
+            if reference is not None and reference.has_size(size):
+                # The index has no samples or CRCs, these files go straight to the full hash
+                reference_sizes.add(size)
+                sample_buckets.append((size, files))
+                continue
+            if len(files) < 2:
+                stats['unique_size'] += sum(len(links.get(entry.path, [entry.path])) for entry in files)
+                continue
+            if not self.comparable(files):
+                stats['single_root'] += len(files)
+                continue
+            # The ZIP directory already has each member's CRC32, so members that are only
+            # compared with other members can be split on it without decompressing anything
+            if all(entry.crc32 is not None for entry in files):
+                crcs = collections.Counter(entry.crc32 for entry in files)
+                stats['unique_crc'] += sum(1 for entry in files if crcs[entry.crc32] < 2)
+                files = [entry for entry in files if crcs[entry.crc32] > 1]
+                if len(files) < 2:
+                    continue
+                if not self.comparable(files):
+                    stats['single_root'] += len(files)
+                    continue
+            # Small files would be read whole by the sample, and ZIP members can't be seeked cheaply
+            if sample_blocks < 1 or size <= sample_block_size * sample_blocks or any("_inside_zip/" in entry.path for entry in files):
+                sample_buckets.append((size, files))
+                continue
+            for entry in files:
+                sample_jobs.append(((size, entry), entry.st_dev, hash_engine.hash_sample, (entry.path, size, sample_block_size, sample_blocks)))
+
+        progress.candidates['size'] = len(sample_jobs) + sum(len(files) for size, files in sample_buckets)
+        progress.start_stage('sampling', len(sample_jobs) * sample_block_size * sample_blocks)
+
+        # The samples are grouped as the workers finish them
+        samples = {}
+        for (size, entry), sample, error in pool.run(sample_jobs):
+            progress.add_bytes(sample_block_size * sample_blocks)
+            if error is not None:
+                stats['errors'] += 1
+                continue
+            stats['sample_bytes_read'] += sample_block_size * sample_blocks
+            samples.setdefault((size, sample), []).append(entry)
+        for (size, sample), files in samples.items():
+            if len(files) < 2:
+                stats['unique_sample'] += 1
+                stats['bytes_avoided'] += size - sample_block_size * sample_blocks
+                continue
+            if not self.comparable(files):
+                stats['single_root'] += len(files)
+                stats['bytes_avoided'] += (size - sample_block_size * sample_blocks) * len(files)
+                continue
+            sample_buckets.append((size, files))
+
+        # Stage 3: full hash of the files whose samples still collide. Files of one bucket
+        # all have the same size, so a bucket's groups are final once each of its files is
+        # hashed; they are sent to the view then, largest files first.
+        sample_buckets.sort(key=lambda bucket: bucket[0], reverse=True)
+        bucket_hashes = [{} for bucket in sample_buckets]
+        bucket_pending = [len(files) for size, files in sample_buckets]
+        duplicates = []
+
+        def file_done(bucket):
+            bucket_pending[bucket] -= 1
+            if bucket_pending[bucket] == 0:
+                size = sample_buckets[bucket][0]
+                for digest, files in bucket_hashes[bucket].items():
+                    library_paths = reference.lookup(size, digest) if size in reference_sizes else []
+                    if library_paths:
+                        # A searched folder can be inside the library, a file isn't a duplicate of itself
+                        searched = {path for entry in files for path in links.get(entry.path, [entry.path])}
+                        library_paths = [path for path in library_paths if path not in searched]
+                    if len(files) > 1 and not library_paths and not self.comparable(files):
+                        stats['single_root'] += len(files)
+                    elif len(files) > 1 or library_paths:
+                        stats['reference_matches'] += len(files) if library_paths else 0
+                        self.add_group(duplicates, size, files, links, stats, library_paths, digest=digest)
+                    else:
+                        stats['unique_hash'] += 1
+                bucket_hashes[bucket] = None
+
+        hash_jobs = []
+        zip_members = {}
+        cached_bytes = 0
+        for bucket, (size, files) in enumerate(sample_buckets):
+            for entry in files:
+                if "_inside_zip/" in entry.path:
+                    zip_members.setdefault(entry.path.split("_inside_zip/", 1)[0], []).append((bucket, size, entry))
+                    continue
+                hash = self.hash_cache.get(entry, hash_engine.name) if self.hash_cache is not None else None
+                if hash is not None:
+                    stats['cache_hits'] += 1
+                    cached_bytes += size
+                    bucket_hashes[bucket].setdefault(hash, []).append(entry)
+                    file_done(bucket)
+                else:
+                    hash_jobs.append(((bucket, size, entry), entry.st_dev, hash_engine.hash_file, (entry.path,)))
+
+        # Each archive is opened once for all of its members that still need a hash
+        for zip_path, members in zip_members.items():
+            inner_files = [entry.path.split("_inside_zip/", 1)[1] for bucket, size, entry in members]
+            hash_jobs.append((members, members[0][2].st_dev, hash_engine.hash_zip_members, (zip_path, inner_files)))
+
+        progress.candidates['sample'] = sum(len(files) for size, files in sample_buckets)
+        progress.start_stage('hashing', sum(size for size, files in sample_buckets for entry in files) - cached_bytes)
+
+        # Groups held back by the batch interval go out once it has passed, not when the next file is done
+        for key, hash, error in pool.run(hash_jobs, self.emit_groups, GROUP_BATCH_INTERVAL):
+            members = key if isinstance(key, list) else [key]
+            progress.add_bytes(sum(size for bucket, size, entry in members))
+            for bucket, size, entry in members:
+                file_hash = hash
+                if error is None and isinstance(key, list):
+                    file_hash = hash.get(entry.path.split("_inside_zip/", 1)[1])
+                if error is not None or file_hash is None:
+                    stats['errors'] += 1
+                else:
+                    stats['bytes_hashed'] += size
+                    if not isinstance(key, list) and entry.st_ino and self.hash_cache is not None:
+                        self.hash_cache.put(entry.path, entry, file_hash, hash_engine.name)
+                    bucket_hashes[bucket].setdefault(file_hash, []).append(entry)
+                file_done(bucket)
+
+        # Save the new digests and drop entries for files that were deleted or changed
+        if self.hash_cache is not None:
+            try:
+                self.hash_cache.commit()
+                stats['cache_evicted'] = self.hash_cache.prune([directory for directory, _ in self.directories], walked,
+                                                               name_filter, drop_missing=not walker.errors)
+            except sqlite3.Error as e:
+                # Not on standard output, the command line writes its results there
+                print(f"Could not update the hash cache: {e}", file=sys.stderr)
+
+        if reference is not None:
+            reference.close()
+
+        progress.candidates['hash'] = stats['duplicate_files']
+        progress.start_stage('done')
+        self.emit_groups(force=True)
+        self.report_stats(stats)
+        return duplicates
+
+    def find_by_metadata(self, size_buckets, links, stats):
+        """Group files on their size, normalized name and dates from the directory listing.
+
+        No file is opened, so this takes as long as listing the folders. Files
+        with the same size and name can still differ, the groups are marked
+        unverified until they are hashed with verify_groups().
+        """
+        keys = self.search_criteria.get('metadata_keys') or ['size', 'name']
+        tolerance_ns = int(self.search_criteria.get('date_tolerance', DEFAULT_DATE_TOLERANCE) * 1e9)
+        entries = []
+        buckets = {}
+        for files in size_buckets.values():
+            for entry in files:
+                # A file with hardlinks goes by every one of its names, not just the one it was listed under
+                names = {normalized_name(path) for path in links.get(entry.path, [entry.path])} if 'name' in keys else [None]
+                for name in names:
+                    buckets.setdefault((entry.st_size if 'size' in keys else None, name), []).append(len(entries))
+                entries.append(entry)
+
+        # Buckets that share a file with several names are one group
+        sets = DisjointSets(len(entries))
+        for numbers in buckets.values():
+            for number in numbers[1:]:
+                sets.union(numbers[0], number)
+
+        duplicates = []
+        for numbers in sets.groups():
+            files = [entries[number] for number in numbers]
+            if len(files) < 2:
+                stats['unique_size'] += len(files)
+                continue
+            # Dates match when they are within the tolerance of each other, not when they are equal
+            runs = [files]
+            for key, field in (('mtime', 'st_mtime_ns'), ('ctime', 'st_ctime_ns')):
+                if key in keys:
+                    runs = [run for files in runs if len(files) > 1 for run in split_by_time(files, field, tolerance_ns)]
+            for run in runs:
+                if len(run) < 2:
+                    stats['unique_size'] += len(run)
+                    continue
+                if not self.comparable(run):
+                    stats['single_root'] += len(run)
+                    continue
+                sizes = [entry.st_size for entry in run]
+                self.add_group(duplicates, sizes[0] if len(set(sizes)) == 1 else sizes, run, links, stats, unverified=True)
+        stats['unverified'] = True
+        self.progress.candidates['metadata'] = stats['duplicate_files']
+        return duplicates
+
+    def find_similar_files(self, size_buckets, links, stats):
+        """Group files whose content is mostly the same, with their percent similar.
+
+        Every file gets a MinHash signature of its chunks in the hash workers.
+        Locality-sensitive hashing then only compares files that have a band of
+        their signature in common, so the work grows with the number of files
+        and not with the number of pairs.
+        """
+        threshold = self.search_criteria.get('percent_similar', 90) / 100
+        progress = self.progress
+        # ZIP members would have to be decompressed in full, they are left to the exact search
+        entries = [entry for files in size_buckets.values() for entry in files
+                   if "_inside_zip/" not in entry.path and entry.st_size > 0]
+        pool = self.make_pool()
+        progress.candidates['size'] = len(entries)
+        progress.start_stage('fingerprinting', sum(entry.st_size for entry in entries))
+        files = []
+        signatures = []
+        for entry, signature, error in pool.run([(entry, entry.st_dev, minhash_file, (entry.path,)) for entry in entries]):
+            progress.add_bytes(entry.st_size)
+            if error is not None:
+                stats['errors'] += 1
+                continue
+            stats['bytes_hashed'] += entry.st_size
+            files.append(entry)
+            signatures.append(signature)
+
+        # One band at a time, so only one band's buckets are in memory. Each file of a
+        # bucket is checked against the bucket's first file of each root it may be
+        # compared with, and joins its group if the estimated similarity is high enough
+        sets = DisjointSets(len(files))
+        rows = lsh_rows_per_band(threshold)
+        for band in range(0, MINHASH_BINS, rows):
+            buckets = {}
+            for number, signature in enumerate(signatures):
+                buckets.setdefault(signature[band:band + rows].tobytes(), []).append(number)
+            for numbers in buckets.values():
+                if len(numbers) < 2:
+                    continue
+                firsts = {}  # root -> first file of the bucket in it
+                for number in numbers:
+                    root = files[number].root
+                    for first_root, first in firsts.items():
+                        if first_root == root and not self.scan_self[root] or sets.find(number) == sets.find(first):
+                            continue
+                        if minhash_similarity(signatures[first], signatures[number]) >= threshold:
+                            sets.union(first, number)
+                    firsts.setdefault(root, number)
+
+        duplicates = []
+        for numbers in sets.groups():
+            if len(numbers) < 2:
+                stats['unique_hash'] += 1
+                continue
+            # Percentages are against the largest file of the group
+            numbers.sort(key=lambda number: files[number].st_size, reverse=True)
+            signature = signatures[numbers[0]]
+            members = [files[number] for number in numbers]
+            self.add_group(duplicates, [entry.st_size for entry in members], members, links, stats,
+                           similarity=[minhash_similarity(signature, signatures[number]) * 100 for number in numbers])
+        progress.candidates['hash'] = stats['duplicate_files']
+        return duplicates
+
+    def find_shared_blocks(self, size_buckets, links, stats):
+        """Group files that have large byte ranges in common, like two versions of a log or a dump.
+
+        The hash workers cut every file into content-defined chunks, and the
+        chunk digests go to an on-disk ChunkIndex. Two files are grouped when the
+        bytes they share are at least percent_similar percent of the smaller
+        one. The stats get how much block-level deduplication of all the files
+        searched would save.
+        """
+        import tempfile
+        threshold = self.search_criteria.get('percent_similar', 90) / 100
+        progress = self.progress
+        entries = [entry for files in size_buckets.values() for entry in files
+                   if "_inside_zip/" not in entry.path and entry.st_size > 0]
+        pool = self.make_pool()
+        progress.candidates['size'] = len(entries)
+        progress.start_stage('chunking', sum(entry.st_size for entry in entries))
+
+        index_file = tempfile.NamedTemporaryFile(prefix="chunks-", suffix=".sqlite3", delete=False)
+        index_file.close()
+        index = ChunkIndex(index_file.name)
+        try:
+            jobs = [((number, entry), entry.st_dev, chunk_file, (entry.path,)) for number, entry in enumerate(entries)]
+            for (number, entry), result, error in pool.run(jobs):
+                progress.add_bytes(entry.st_size)
+                if error is not None:
+                    stats['errors'] += 1
+                    continue
+                index.add_file(number, *result)
+                stats['bytes_hashed'] += entry.st_size
+            index.commit()
+
+            total, unique = index.dedupe_estimate()
+            stats['chunked_bytes'] = total
+            stats['block_dedupe_bytes'] = total - unique
+
+            # Pairs that share enough of the smaller file are joined into groups, each
+            # file keeps the largest share of its bytes found in another file
+            sets = DisjointSets(len(entries))
+            best_share = {}
+            for number, other, shared in index.shared_bytes():
+                entry, other_entry = entries[number], entries[other]
+                if entry.root == other_entry.root and not self.scan_self[entry.root]:
+                    continue
+                if shared < threshold * min(entry.st_size, other_entry.st_size):
+                    continue
+                best_share[number] = max(best_share.get(number, 0), min(shared / entry.st_size, 1.0))
+                best_share[other] = max(best_share.get(other, 0), min(shared / other_entry.st_size, 1.0))
+                sets.union(number, other)
+        finally:
+            index.close()
+            os.remove(index_file.name)
+
+        duplicates = []
+        for numbers in sets.groups(best_share):
+            numbers.sort(key=lambda number: entries[number].st_size, reverse=True)
+            members = [entries[number] for number in numbers]
+            self.add_group(duplicates, [entry.st_size for entry in members], members, links, stats,
+                           similarity=[best_share[number] * 100 for number in numbers])
+        stats['unique_hash'] = len(entries) - stats['duplicate_files']
+        progress.candidates['hash'] = stats['duplicate_files']
+        return duplicates
+
+    def find_similar_images(self, size_buckets, links, stats):
+        """Group images that look the same, resized or saved at another quality.
+
+        The hash workers compute a perceptual hash of every image that passed the
+        extension filters. A BK-tree then finds the images within the allowed
+        Hamming distance of each one, instead of comparing every pair.
+        """
+        if not pillow_available():
+            raise ImportError("Searching for similar images needs Pillow: pip install Pillow")
+        method = self.search_criteria.get('image_hash', DEFAULT_IMAGE_HASH)
+        max_distance = self.search_criteria.get('image_distance', DEFAULT_IMAGE_DISTANCE)
+        progress = self.progress
+        entries = [entry for files in size_buckets.values() for entry in files
+                   if "_inside_zip/" not in entry.path and os.path.splitext(entry.path)[1][1:].lower() in IMAGE_EXTENSIONS]
+        pool = self.make_pool()
+        progress.candidates['size'] = len(entries)
+        progress.start_stage('fingerprinting', sum(entry.st_size for entry in entries))
+        files = []
+        hashes = []
+        tree = BKTree()
+        sets = DisjointSets()
+
+        for entry, value, error in pool.run([(entry, entry.st_dev, image_hash, (entry.path, method)) for entry in entries]):
+            progress.add_bytes(entry.st_size)
+            if error is not None:
+                stats['errors'] += 1
+                continue
+            stats['bytes_hashed'] += entry.st_size
+            number = sets.add()
+            files.append(entry)
+            hashes.append(value)
+            # Each image is looked up among the ones before it, then added
+            for distance, other in tree.search(value, max_distance):
+                if files[other].root == entry.root and not self.scan_self[entry.root]:
+                    continue
+                sets.union(other, number)
+            tree.add(value, number)
+
+        duplicates = []
+        for numbers in sets.groups():
+            if len(numbers) < 2:
+                stats['unique_hash'] += 1
+                continue
+            # Percentages are against the largest file, usually the best quality one
+            numbers.sort(key=lambda number: files[number].st_size, reverse=True)
+            members = [files[number] for number in numbers]
+            similarity = [(1 - hamming_distance(hashes[numbers[0]], hashes[number]) / 64) * 100 for number in numbers]
+            self.add_group(duplicates, [entry.st_size for entry in members], members, links, stats, similarity=similarity)
+        progress.candidates['hash'] = stats['duplicate_files']
+        return duplicates
+
+    def comparable(self, files):
+        """Whether files of the same size (or content) hold a pair that may be compared.
+
+        A pair in one root only counts if that root is scanned against itself, so
+        buckets made of a single such root are dropped before anything is read.
+        """
+        roots = collections.Counter(entry.root for entry in files)
+        return len(roots) > 1 or any(count > 1 and self.scan_self[root] for root, count in roots.items())
+
+    def make_pool(self):
+        return HashWorkerPool(self.search_criteria.get('hash_workers'),
+                              self.search_criteria.get('use_processes', False),
+                              self.search_criteria.get('per_device_workers'))
+
+    def add_group(self, duplicates, size, files, links, stats, library_paths=(), **details):
+        """Make the DuplicateGroup of files, count it and queue it for on_groups.
+
+        Each member is the list of paths that share one inode. Library files of
+        the reference index come last and count as kept, so every new copy is
+        space that can be freed.
+        """
+        freeable = [freeable_bytes(entry, links) for entry in files] + [None] * len(library_paths)
+        members = [links.get(entry.path, [entry.path]) for entry in files] + [[path] for path in library_paths]
+        group = DuplicateGroup(size, members, freeable=freeable, **details)
+        duplicates.append(group)
+        self.pending_groups.append(group)
+        stats['duplicate_files'] += len(files)
+        stats['reclaimable_bytes'] += group_reclaimable_bytes(freeable)
+        self.emit_groups()
+        return group
+
+    def report_stats(self, stats):
+        if self.on_stats is not None:
+            self.on_stats(stats)
+
+    def emit_groups(self, force=False):
+        """Send the groups confirmed since the last batch, unless a batch went out very recently."""
+        now = time.monotonic()
+        if self.pending_groups and (force or now - self.last_groups_emit >= GROUP_BATCH_INTERVAL):
+            if self.on_groups is not None:
+                self.on_groups(self.pending_groups)
+            self.pending_groups = []
+            self.last_groups_emit = now
+
+
+class ScanProgress:
+    """Counters for a running search, passed to a callback at most once per interval.
+
+    The callback gets the dict from snapshot(). The same counters can be read
+    directly by code that isn't using the GUI.
+    """
+
+    def __init__(self, callback=None, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.start_time = time.monotonic()
+        self.stage = 'walking'
+        self.stage_start_time = self.start_time
+        self.directories_walked = 0
+        self.files_seen = 0
+        # Files still in the running after each stage, in the order the stages ran
+        self.candidates = {}
+        self.bytes_planned = 0
+        self.bytes_done = 0
+        self.last_report_time = 0
+        self.last_report_bytes = 0
+        self.rate = 0.0
+
+    def start_stage(self, stage, bytes_planned=0):
+        self.stage = stage
+        self.stage_start_time = time.monotonic()
+        self.bytes_planned = bytes_planned
+        self.bytes_done = 0
+        self.last_report_bytes = 0
+        self.rate = 0.0
+        self.report(force=True)
+
+    def add_bytes(self, count):
+        self.bytes_done += count
+        self.report()
+
+    def snapshot(self):
+        now = time.monotonic()
+        stage_elapsed = max(now - self.stage_start_time, 1e-9)
+        average_rate = self.bytes_done / stage_elapsed
+        remaining = max(self.bytes_planned - self.bytes_done, 0)
+        return {
+            'stage': self.stage,
+            'elapsed': now - self.start_time,
+            'directories_walked': self.directories_walked,
+            'files_seen': self.files_seen,
+            'candidates': dict(self.candidates),
+            'bytes_done': self.bytes_done,
+            'bytes_planned': self.bytes_planned,
+            'percent': 100.0 * self.bytes_done / self.bytes_planned if self.bytes_planned else 0.0,
+            'mb_per_second': self.rate / (1024 * 1024),
+            'average_mb_per_second': average_rate / (1024 * 1024),
+            'eta_seconds': remaining / average_rate if average_rate > 0 else None,
+        }
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_report_time < self.interval:
+            return
+        if self.last_report_time and now > self.last_report_time:
+            self.rate = (self.bytes_done - self.last_report_bytes) / (now - self.last_report_time)
+        self.last_report_time = now
+        self.last_report_bytes = self.bytes_done
+        if self.callback is not None:
+            self.callback(self.snapshot())
+
+
+def parse_date(text, end_of_day=False):
+    """Local midnight of a "YYYY-MM-DD" date in nanoseconds, or of the day after with end_of_day.
+
+    Raises ValueError for anything else. With end_of_day the result is the
+    first moment after the date, so a range includes the whole last day.
+    """
+    day = datetime.datetime.strptime(text.strip(), "%Y-%m-%d")
+    if end_of_day:
+        day += datetime.timedelta(days=1)
+    return int(day.timestamp()) * 1000000000
+
+def format_size(size):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def format_progress(progress):
+    """One line description of a ScanProgress snapshot."""
+    if progress['stage'] == 'walking':
+        return f"Listing folders: {progress['directories_walked']} folders, {progress['files_seen']} files"
+    if progress['stage'] == 'done':
+        return f"Done in {progress['elapsed']:.0f} s"
+    text = (f"{progress['stage'].capitalize()}: {format_size(progress['bytes_done'])} of "
+            f"{format_size(progress['bytes_planned'])}, {progress['mb_per_second']:.1f} MB/s "
+            f"(average {progress['average_mb_per_second']:.1f} MB/s)")
+    if progress['eta_seconds'] is not None:
+        minutes, seconds = divmod(int(progress['eta_seconds']), 60)
+        text += f", {minutes // 60}:{minutes % 60:02d}:{seconds:02d} left"
+    return text
+
+
+# A file found by the walker, with the stat fields the search needs. The field
+# names match os.stat_result so an entry can be used wherever a stat is expected.
+# ZIP members also carry the CRC32 from the archive directory, and have no ctime.
+ScanEntry = collections.namedtuple('ScanEntry', ['path', 'root', 'st_size', 'st_mtime_ns', 'st_dev', 'st_ino', 'st_nlink', 'st_blocks', 'crc32', 'st_ctime_ns'], defaults=(None, None))
+
+def scan_entry(path, root, file_stat):
+    # Windows has no st_blocks, so assume the size rounded up to 4 KB clusters
+    blocks = getattr(file_stat, 'st_blocks', (file_stat.st_size + 4095) // 4096 * 8)
+    return ScanEntry(path, root, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_dev, file_stat.st_ino, file_stat.st_nlink, blocks,
+                     st_ctime_ns=file_stat.st_ctime_ns)
+
+def freeable_bytes(entry, links):
+    """Disk space freed by deleting one file, or None if that frees nothing.
+
+    Space is counted per inode from its allocated blocks, and only for inodes
+    whose every hardlink is in the results, since deleting some links of a file
+    frees nothing.
+    """
+    paths = links.get(entry.path, [entry.path])
+    if not entry.st_ino or len(paths) >= entry.st_nlink:
+        return entry.st_blocks * 512
+    return None
+
+def group_reclaimable_bytes(freeable):
+    """Disk space freed by keeping one file of a group, from each file's freeable_bytes()."""
+    counted = [size for size in freeable if size is not None]
+    if len(freeable) < 2 or not counted:
+        return 0
+    # One copy has to stay, keep the largest one if none has links elsewhere
+    return sum(counted) - (max(counted) if len(counted) == len(freeable) else 0)
+
+class DisjointSets:
+    """Union-find over the numbers 0 to count - 1, to join files that matched into groups."""
+
+    def __init__(self, count=0):
+        self.parents = list(range(count))
+
+    def add(self):
+        self.parents.append(len(self.parents))
+        return len(self.parents) - 1
+
+    def find(self, number):
+        parents = self.parents
+        while parents[number] != number:
+            parents[number] = parents[parents[number]]
+            number = parents[number]
+        return number
+
+    def union(self, number, other):
+        self.parents[self.find(other)] = self.find(number)
+
+    def groups(self, numbers=None):
+        """Lists of the joined numbers, each in the order of numbers (all of them by default)."""
+        components = {}
+        for number in range(len(self.parents)) if numbers is None else numbers:
+            components.setdefault(self.find(number), []).append(number)
+        return list(components.values())
+
+def merge_roots(directories):
+    """Drop the (directory, scan_self) pairs that repeat a folder or sit inside another one.
+
+    Otherwise their files would be listed twice and reported as duplicates of
+    themselves. A folder listed twice is scanned against itself if either copy
+    is, a folder inside another is searched as part of it.
+    """
+    real_paths = [os.path.normcase(os.path.realpath(directory)) for directory, _ in directories]
+    merged = []
+    for number, (directory, scan_self) in enumerate(directories):
+        real_path = real_paths[number]
+        if real_path in real_paths[:number]:
+            continue  # Only the first copy is kept
+        if any(real_path.startswith(other.rstrip(os.sep) + os.sep) for other in real_paths if other != real_path):
+            continue
+        scan_self = any(other_scan_self for other, (_, other_scan_self) in zip(real_paths, directories) if other == real_path)
+        merged.append((directory, scan_self))
+    return merged
+
+class DirectoryWalker:
+    """Lists directories with os.scandir, several subtrees at a time.
+
+    The stat of each directory entry is kept, so every file is stat'ed at most
+    once, and files whose name fails name_filter are never stat'ed at all.
+    """
+
+    def __init__(self, workers=None, name_filter=None):
+        self.workers = workers or DEFAULT_WALK_WORKERS
+        self.name_filter = name_filter
+        self.directories_walked = 0
+        self.files_skipped = 0
+        self.errors = 0
+
+    def walk(self, directories):
+        """Yield a ScanEntry for every file under the directories, in no particular order."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            running = {executor.submit(self.scan_directory, directory, root) for root, directory in enumerate(directories)}
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entries, subdirectories, root, skipped, errors = future.result()
+                    self.directories_walked += 1
+                    self.files_skipped += skipped
+                    self.errors += errors
+                    for subdirectory in subdirectories:
+                        running.add(executor.submit(self.scan_directory, subdirectory, root))
+                    yield from entries
+
+    def scan_directory(self, directory, root):
+        entries = []
+        subdirectories = []
+        skipped = 0
+        errors = 0
+        try:
+            with os.scandir(directory) as iterator:
+                for dir_entry in iterator:
+                    try:
+                        # Like os.walk, symlinked folders are not followed
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(dir_entry.path)
+                            continue
+                        # Symlinked files are skipped too. Their stat is the target's, so they would
+                        # look like hardlinks of it, and deleting one could leave only the link behind
+                        if not dir_entry.is_file(follow_symlinks=False):
+                            continue
+                        if self.name_filter is not None and not self.name_filter(dir_entry.name):
+                            skipped += 1
+                            continue
+                        entries.append(scan_entry(dir_entry.path, root, dir_entry.stat(follow_symlinks=False)))
+                    except OSError:
+                        errors += 1
+        except OSError:
+            errors += 1
+        return entries, subdirectories, root, skipped, errors
+
+
+# Hash algorithms the search can use: name -> (module, constructor). The ones
+# outside hashlib are only offered when their package is installed.
+HASH_ALGORITHMS = {
+    'sha256': ('hashlib', 'sha256'),
+    'blake2b': ('hashlib', 'blake2b'),
+    'blake2s': ('hashlib', 'blake2s'),
+    'blake3': ('blake3', 'blake3'),
+    'xxh3_128': ('xxhash', 'xxh3_128'),
+    'xxh64': ('xxhash', 'xxh64'),
+}
+DEFAULT_HASH_ALGORITHM = 'sha256'
+DEFAULT_HASH_BLOCK_SIZE = 65536
+
+_hash_constructors = {}
+
+def get_hash_constructor(algorithm):
+    if algorithm not in _hash_constructors:
+        module_name, constructor_name = HASH_ALGORITHMS[algorithm]
+        try:
+            _hash_constructors[algorithm] = getattr(importlib.import_module(module_name), constructor_name)
+        except ImportError:
+            _hash_constructors[algorithm] = None
+    return _hash_constructors[algorithm]
+
+def available_hash_algorithms():
+    return [algorithm for algorithm in HASH_ALGORITHMS if get_hash_constructor(algorithm) is not None]
+
+def benchmark_hash_algorithms(data_size=32 * 1024 * 1024, block_size=DEFAULT_HASH_BLOCK_SIZE):
+    """Return the hashing speed of every available algorithm in MB/s, fastest first."""
+    block = os.urandom(block_size)
+    results = {}
+    for algorithm in available_hash_algorithms():
+        file_hash = get_hash_constructor(algorithm)()
+        start = time.perf_counter()
+        for _ in range(max(data_size // block_size, 1)):
+            file_hash.update(block)
+        file_hash.hexdigest()
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        results[algorithm] = data_size / elapsed / (1024 * 1024)
+    return dict(sorted(results.items(), key=lambda item: item[1], reverse=True))
+
+_fastest_hash_algorithm = None
+
+def fastest_hash_algorithm():
+    # The benchmark runs once per session, the first time it's needed
+    global _fastest_hash_algorithm
+    if _fastest_hash_algorithm is None:
+        _fastest_hash_algorithm = next(iter(benchmark_hash_algorithms()))
+    return _fastest_hash_algorithm
+
+
+# How HashEngine reads files: 'read' allocates every block, 'readinto' reuses one
+# buffer, 'mmap' maps the file, 'file_digest' is hashlib.file_digest (Python 3.11+)
+# and 'auto' maps large files and uses file_digest or readinto for the rest
+HASH_IO_STRATEGIES = ['auto', 'readinto', 'mmap', 'file_digest', 'read']
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+_read_buffers = threading.local()
+
+def get_read_buffer(size):
+    """Return this thread's read buffer and a memoryview of it, at least size bytes long."""
+    if getattr(_read_buffers, 'size', 0) < size:
+        _read_buffers.buffer = bytearray(size)
+        _read_buffers.view = memoryview(_read_buffers.buffer)
+        _read_buffers.size = size
+    return _read_buffers.buffer, _read_buffers.view
+
+def benchmark_io_strategies(hash_engine, file_size=256 * 1024 * 1024, directory=None):
+    """Hash a temporary file with every reading strategy.
+
+    Returns strategy -> (MB/s, CPU seconds per GB). The file is read once first so
+    it comes from the page cache, which leaves the CPU cost of each strategy.
+    """
+    import tempfile
+    results = {}
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(max(file_size // len(block), 1)):
+            f.write(block)
+        temp_path = f.name
+    try:
+        hash_engine.hash_file(temp_path, 'readinto')
+        size_in_gb = os.path.getsize(temp_path) / (1024 ** 3)
+        for io_strategy in HASH_IO_STRATEGIES[1:]:
+            if io_strategy == 'file_digest' and not hasattr(hashlib, 'file_digest'):
+                continue
+            start_cpu = time.process_time()
+            start = time.perf_counter()
+            hash_engine.hash_file(temp_path, io_strategy)
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            cpu = time.process_time() - start_cpu
+            results[io_strategy] = (size_in_gb * 1024 / elapsed, cpu / size_in_gb)
+    finally:
+        os.remove(temp_path)
+    return results
+
+
+class HashEngine:
+    """Hashes files, samples of files and ZIP members with one algorithm.
+
+    Digests are only comparable between engines with the same name, so the
+    name is stored with every cached digest and every search result.
+    """
+
+    def __init__(self, algorithm=DEFAULT_HASH_ALGORITHM, block_size=DEFAULT_HASH_BLOCK_SIZE, io_strategy='auto'):
+        if algorithm == 'auto':
+            algorithm = fastest_hash_algorithm()
+        if get_hash_constructor(algorithm) is None:
+            raise ValueError(f"Hash algorithm {algorithm} is not available")
+        if io_strategy not in HASH_IO_STRATEGIES:
+            raise ValueError(f"Unknown file reading strategy {io_strategy}")
+        self.name = algorithm
+        self.block_size = block_size
+        self.io_strategy = io_strategy
+
+    def new(self):
+        return get_hash_constructor(self.name)()
+
+    def hash_file(self, file_path, io_strategy=None):
+        # Create a hash for the file
+        io_strategy = io_strategy or self.io_strategy
+        file_hash = self.new()
+        with open(file_path, "rb", buffering=0) as f:
+            if io_strategy == 'auto':
+                file_size = os.fstat(f.fileno()).st_size
+                if file_size >= MMAP_THRESHOLD:
+                    io_strategy = 'mmap'
+                elif hasattr(hashlib, 'file_digest'):
+                    io_strategy = 'file_digest'
+                else:
+                    io_strategy = 'readinto'
+
+            if io_strategy == 'mmap':
+                try:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        # hashlib releases the GIL for the whole update, so no copy and no loop
+                        with memoryview(mapped) as view:
+                            file_hash.update(view)
+                    return file_hash.hexdigest()
+                except (ValueError, OSError, OverflowError):
+                    # Empty files, special files and address space limits, read the normal way
+                    f.seek(0)
+                    io_strategy = 'readinto'
+
+            if io_strategy == 'file_digest' and hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(f, self.new).hexdigest()
+
+            if io_strategy == 'read':
+                block_size = self.block_size
+                for block in iter(lambda: f.read(block_size), b""):
+                    file_hash.update(block)
+                return file_hash.hexdigest()
+
+            # Read into one buffer per thread that is reused for every block of every file
+            buffer, view = get_read_buffer(self.block_size)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                file_hash.update(view[:count])
+        return file_hash.hexdigest()
+
+    def hash_sample(self, file_path, file_size, block_size=SAMPLE_BLOCK_SIZE, blocks=SAMPLE_BLOCKS):
+        """Hash the first block, the last block and evenly spaced blocks in between."""
+        sample_hash = self.new()
+        last_offset = max(file_size - block_size, 0)
+        offsets = [last_offset * i // max(blocks - 1, 1) for i in range(blocks)]
+        buffer, view = get_read_buffer(block_size)
+        with open(file_path, "rb", buffering=0) as f:
+            for offset in offsets:
+                f.seek(offset)
+                count = f.readinto(view[:block_size])
+                sample_hash.update(view[:count])
+        return sample_hash.hexdigest()
+
+    def hash_zip_member(self, file):
+        zip_path, inner_file = file.split("_inside_zip/", 1)
+        return self.hash_zip_members(zip_path, [inner_file])[inner_file]
+
+    def hash_zip_members(self, zip_path, inner_files):
+        """Hash several members of one archive, returns a dict of member name -> digest.
+
+        Members are decompressed a block at a time, so memory use doesn't depend on
+        their size. Members that can't be read (including a CRC mismatch) are left out.
+        """
+        import zipfile
+        digests = {}
+        block_size = self.block_size
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for inner_file in inner_files:
+                member_hash = self.new()
+                try:
+                    with zip_ref.open(inner_file, 'r') as file_in_zip:
+                        for block in iter(lambda: file_in_zip.read(block_size), b""):
+                            member_hash.update(block)
+                except (zipfile.BadZipFile, KeyError, NotImplementedError, RuntimeError, OSError):
+                    continue
+                digests[inner_file] = member_hash.hexdigest()
+        return digests
+
+
+def device_is_rotational(device):
+    # Linux reports spinning disks in sysfs, everything else is treated as solid state
+    if not sys.platform.startswith("linux"):
+        return False
+    block_path = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+    for queue_path in (os.path.join(block_path, "queue", "rotational"), os.path.join(block_path, "..", "queue", "rotational")):
+        try:
+            with open(queue_path) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+class HashWorkerPool:
+    """Runs hash jobs on a pool of threads (or processes) and yields the results as they finish.
+
+    Jobs are queued per device, so a spinning disk only gets one read at a time
+    while solid state drives are read by every worker.
+    """
+
+    def __init__(self, workers=None, use_processes=False, per_device=None):
+        self.workers = workers or DEFAULT_HASH_WORKERS
+        self.use_processes = use_processes
+        self.per_device = per_device
+        self.device_limits = {}
+
+    def device_limit(self, device):
+        if self.per_device:
+            return self.per_device
+        if device not in self.device_limits:
+            self.device_limits[device] = 1 if device_is_rotational(device) else self.workers
+        return self.device_limits[device]
+
+    def run(self, jobs, on_wait=None, wait_interval=None):
+        """Yield (key, result, error) for every (key, device, function, args) job.
+
+        on_wait is called every time the pool stops waiting, at least every
+        wait_interval seconds, even while a large file keeps every worker busy.
+        """
+        queues = {}
+        for job in jobs:
+            queues.setdefault(job[1], collections.deque()).append(job)
+        if not queues:
+            return
+
+        executor_class = ThreadPoolExecutor
+        if self.use_processes:
+            # Loads multiprocessing, so only when processes are asked for
+            from concurrent.futures import ProcessPoolExecutor as executor_class
+        running = {}
+        busy = collections.Counter()
+        with executor_class(max_workers=self.workers) as executor:
+            while queues or running:
+                # Top up every device to its limit, but never queue much more than the pool can run
+                for device in list(queues):
+                    queue = queues[device]
+                    while queue and busy[device] < self.device_limit(device) and len(running) < self.workers * 2:
+                        key, _, function, args = queue.popleft()
+                        running[executor.submit(function, *args)] = (key, device)
+                        busy[device] += 1
+                    if not queue:
+                        del queues[device]
+
+                done, _ = wait(running, timeout=wait_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, device = running.pop(future)
+                    busy[device] -= 1
+                    try:
+                        yield key, future.result(), None
+                    except Exception as e:
+                        yield key, None, e
+                if on_wait is not None:
+                    on_wait()
+
+
+class HashCache:
+    """Digests saved on disk, keyed by device, inode, size and modification time."""
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_config_dir(), "hash_cache.sqlite3")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "device INTEGER, inode INTEGER, algorithm TEXT, size INTEGER, mtime_ns INTEGER, path TEXT, digest TEXT, "
+            "PRIMARY KEY (device, inode, algorithm))")
+        self.connection.commit()
+
+    def get(self, file_stat, algorithm="sha256"):
+        # Some file systems don't have stable inode numbers, those files are never cached
+        if not file_stat.st_ino:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, digest FROM hashes WHERE device = ? AND inode = ? AND algorithm = ?",
+                (file_stat.st_dev, file_stat.st_ino, algorithm)).fetchone()
+            if row is None:
+                return None
+            if row[0] != file_stat.st_size or row[1] != file_stat.st_mtime_ns:
+                # The file changed since it was hashed
+                self.connection.execute(
+                    "DELETE FROM hashes WHERE device = ? AND inode = ? AND algorithm = ?",
+                    (file_stat.st_dev, file_stat.st_ino, algorithm))
+                self._count_change()
+                return None
+            return row[2]
+
+    def put(self, file_path, file_stat, digest, algorithm="sha256"):
+        if not file_stat.st_ino:
+            return
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (file_stat.st_dev, file_stat.st_ino, algorithm, file_stat.st_size, file_stat.st_mtime_ns, file_path, digest))
+            self._count_change()
+
+    def prune(self, directories, walked, name_filter=None, drop_missing=True):
+        """Remove entries under the given directories whose file is gone or changed.
+
+        walked maps every path the search just listed to its ScanEntry, so no
+        file is stat'ed a second time. Paths the listing left out because of
+        name_filter are kept, and so are all unlisted paths when drop_missing
+        is False, for example after a folder could not be read.
+        """
+        removed = 0
+        with self.lock:
+            for directory in directories:
+                prefix = os.path.join(directory, "")
+                rows = self.connection.execute(
+                    "SELECT device, inode, algorithm, size, mtime_ns, path FROM hashes WHERE substr(path, 1, ?) = ?",
+                    (len(prefix), prefix)).fetchall()
+                for device, inode, algorithm, size, mtime_ns, path in rows:
+                    entry = walked.get(path)
+                    if entry is None and (not drop_missing or (name_filter is not None and not name_filter(os.path.basename(path)))):
+                        continue
+                    # Windows listings have no inode, then only the size and time can be checked
+                    if (entry is None or (entry.st_ino and (entry.st_dev != device or entry.st_ino != inode))
+                            or entry.st_size != size or entry.st_mtime_ns != mtime_ns):
+                        self.connection.execute(
+                            "DELETE FROM hashes WHERE device = ? AND inode = ? AND algorithm = ?",
+                            (device, inode, algorithm))
+                        removed += 1
+            self.connection.commit()
+            self.pending = 0
+        return removed
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def _count_change(self):
+        # Commit in batches so a large scan doesn't sync the database for every file
+        self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.connection.commit()
+            self.pending = 0
+
+
+class ReferenceIndex:
+    """Size and digest of every file of a library, saved in SQLite.
+
+    Built once from the library folders, then later searches check new
+    folders against it instead of scanning the library again. Rebuilding only
+    hashes the files that are new or changed since the last build.
+    """
+    COMMIT_EVERY = 10000
+    VERSION = 1
+    FILE_COLUMNS = ['path', 'size', 'mtime_ns', 'digest', 'build']
+
+    def __init__(self, path, read_only=False):
+        """Open the index at path, a new one is created unless read_only.
+
+        Raises ValueError if the file is something other than a reference index,
+        which is left untouched.
+        """
+        self.path = path
+        if read_only:
+            # A search only reads the index, so a wrong file picked by mistake is never changed
+            import pathlib
+            uri = pathlib.Path(os.path.abspath(path)).as_uri() + "?mode=ro"
+            self.connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+        try:
+            tables = {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if tables or read_only:
+                self.check_schema(tables)
+            else:
+                self.connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+                self.connection.execute(
+                    "CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                    "digest TEXT, build INTEGER) WITHOUT ROWID")
+                self.connection.execute("CREATE INDEX files_size ON files (size, digest)")
+                self.set_info('version', self.VERSION)
+                self.connection.commit()
+        except (sqlite3.Error, ValueError) as e:
+            self.connection.close()
+            if isinstance(e, ValueError):
+                raise
+            raise ValueError(f"{path} is not a reference index: {e}")
+
+    def check_schema(self, tables):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if 'info' not in tables or columns != self.FILE_COLUMNS:
+            raise ValueError(f"{self.path} is not a reference index")
+        # Indexes made before the version was stored have the same tables as version 1
+        version = self.get_info('version', str(self.VERSION))
+        if version != str(self.VERSION):
+            raise ValueError(f"{self.path} is a version {version} reference index, this program reads version {self.VERSION}")
+
+    def get_info(self, key, default=None):
+        row = self.connection.execute("SELECT value FROM info WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_info(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO info VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def algorithm(self):
+        # Digests of the new files have to be made with the algorithm the index was built with
+        return self.get_info('algorithm')
+
+    def file_count(self):
+        return self.connection.execute("SELECT count(*) FROM files").fetchone()[0]
+
+    def has_size(self, size):
+        return self.connection.execute("SELECT 1 FROM files WHERE size = ? LIMIT 1", (size,)).fetchone() is not None
+
+    def lookup(self, size, digest):
+        """Paths of the library files with this size and digest."""
+        return [row[0] for row in self.connection.execute("SELECT path FROM files WHERE size = ? AND digest = ?", (size, digest))]
+
+    def build(self, directories, algorithm=DEFAULT_HASH_ALGORITHM, hash_cache=None, workers=None, on_progress=None):
+        """Add the files under the directories, and drop the ones that are gone.
+
+        Returns a stats dict with the files indexed, hashed, kept from the last
+        build and removed.
+        """
+        hash_engine = HashEngine(algorithm)
+        if self.algorithm not in (None, hash_engine.name):
+            # Digests of another algorithm can't be compared, start over
+            self.connection.execute("DELETE FROM files")
+        self.set_info('algorithm', hash_engine.name)
+        build = int(self.get_info('build', 0)) + 1
+        self.set_info('build', build)
+
+        stats = {'files': 0, 'hashed': 0, 'unchanged': 0, 'removed': 0, 'errors': 0, 'algorithm': hash_engine.name}
+        progress = ScanProgress(on_progress)
+        walker = DirectoryWalker()
+        hash_jobs = []
+        pending = 0
+        for entry in walker.walk([directory for directory, _ in merge_roots([(directory, True) for directory in directories])]):
+            stats['files'] += 1
+            progress.files_seen = stats['files']
+            progress.directories_walked = walker.directories_walked
+            progress.report()
+            row = self.connection.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (entry.path,)).fetchone()
+            if row is not None and row[0] == entry.st_size and row[1] == entry.st_mtime_ns:
+                self.connection.execute("UPDATE files SET build = ? WHERE path = ?", (build, entry.path))
+                stats['unchanged'] += 1
+                continue
+            digest = hash_cache.get(entry, hash_engine.name) if hash_cache is not None else None
+            if digest is not None:
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                        (entry.path, entry.st_size, entry.st_mtime_ns, digest, build))
+                stats['hashed'] += 1
+            else:
+                hash_jobs.append((entry, entry.st_dev, hash_engine.hash_file, (entry.path,)))
+            pending += 1
+            if pending >= self.COMMIT_EVERY:
+                self.connection.commit()
+                pending = 0
+        stats['errors'] += walker.errors
+
+        progress.start_stage('hashing', sum(entry.st_size for entry, device, function, args in hash_jobs))
+        pool = HashWorkerPool(workers)
+        for entry, digest, error in pool.run(hash_jobs):
+            progress.add_bytes(entry.st_size)
+            if error is not None:
+                stats['errors'] += 1
+                continue
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                    (entry.path, entry.st_size, entry.st_mtime_ns, digest, build))
+            if hash_cache is not None and entry.st_ino:
+                hash_cache.put(entry.path, entry, digest, hash_engine.name)
+            stats['hashed'] += 1
+            pending += 1
+            if pending >= self.COMMIT_EVERY:
+                self.connection.commit()
+                pending = 0
+
+        # Files under the rebuilt folders that this build didn't see were deleted or moved
+        for directory in directories:
+            prefix = os.path.join(directory, "")
+            stats['removed'] += self.connection.execute(
+                "DELETE FROM files WHERE build != ? AND substr(path, 1, ?) = ?", (build, len(prefix), prefix)).rowcount
+        self.connection.commit()
+        if hash_cache is not None:
+            hash_cache.commit()
+        progress.start_stage('done')
+        return stats
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def cached_file_hash(file_path, hash_engine, hash_cache=None):
+    # Reuse the saved digest if the file hasn't changed since it was last hashed
+    file_stat = os.stat(file_path)
+    if hash_cache is not None:
+        digest = hash_cache.get(file_stat, hash_engine.name)
+        if digest is not None:
+            return digest
+
+    digest = hash_engine.hash_file(file_path)
+
+    if hash_cache is not None:
+        hash_cache.put(file_path, file_stat, digest, hash_engine.name)
+    return digest
+
+
+# Content-defined chunking. Each byte is mapped to one bit by a fixed table, a
+# gear hash whose gear values are single bits, and a chunk ends where the last
+# CHUNK_PATTERN_BITS bits spell CHUNK_PATTERN. Cut points depend only on the
+# bytes around them, so an insertion early in a file only changes the chunks
+# near it. bytes.translate and bytes.find do the per byte work in C.
+CHUNK_PATTERN_BITS = 13  # About one cut every 8 KB of varied data
+CHUNK_PATTERN = b"1110010110000"  # Mixed bits and no overlap with itself, runs of equal bytes never match it
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+_chunk_table_bits = hashlib.sha256(b"DuplicateFileFinder chunker").digest()
+CHUNK_TABLE = bytes(b"01"[(_chunk_table_bits[value // 8] >> (value % 8)) & 1] for value in range(256))
+
+def iter_chunks(file, block_size=4 * 1024 * 1024):
+    """Yield the content-defined chunks of a binary file object, as bytes."""
+    buffer = b""
+    while True:
+        data = file.read(block_size)
+        buffer += data
+        bits = buffer.translate(CHUNK_TABLE)
+        start = 0
+        while True:
+            # The pattern has to end at least CHUNK_MIN_SIZE into the chunk, and at most CHUNK_MAX_SIZE
+            position = bits.find(CHUNK_PATTERN, start + CHUNK_MIN_SIZE - CHUNK_PATTERN_BITS, start + CHUNK_MAX_SIZE)
+            if position >= 0:
+                end = position + CHUNK_PATTERN_BITS
+            elif len(buffer) - start >= CHUNK_MAX_SIZE:
+                end = start + CHUNK_MAX_SIZE
+            elif not data and start < len(buffer):
+                end = len(buffer)  # The end of the file ends the last chunk
+            else:
+                break
+            yield buffer[start:end]
+            start = end
+        buffer = buffer[start:]
+        if not data:
+            return
+
+def chunk_digest(chunk):
+    # 64 bits are plenty to tell chunks apart within one search
+    return int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "little")
+
+
+# MinHash with one permutation: every chunk digest goes to one of MINHASH_BINS
+# bins and each bin keeps its smallest value. The share of equal bins between
+# two signatures estimates the share of chunks the files have in common.
+MINHASH_BINS = 64
+MINHASH_EMPTY = 1 << 32
+
+def minhash_file(file_path):
+    """MinHash signature of a file's chunks as an array of 32 bit values, or None for an empty file."""
+    mins = [MINHASH_EMPTY] * MINHASH_BINS
+    with open(file_path, "rb") as f:
+        for chunk in iter_chunks(f):
+            digest = chunk_digest(chunk)
+            value = digest >> 32
+            if value < mins[digest % MINHASH_BINS]:
+                mins[digest % MINHASH_BINS] = value
+    if all(value == MINHASH_EMPTY for value in mins):
+        return None
+    # Files with few chunks leave bins empty, they borrow from the next filled bin
+    # (shifted by the distance) so equal files still get equal signatures
+    filled = list(mins)
+    for number in range(MINHASH_BINS):
+        distance = 0
+        while filled[(number + distance) % MINHASH_BINS] == MINHASH_EMPTY:
+            distance += 1
+        if distance:
+            mins[number] = (filled[(number + distance) % MINHASH_BINS] + distance * 0x9E3779B1) & 0xFFFFFFFF
+    return array('I', mins)
+
+def minhash_similarity(signature, other):
+    """Estimated share of common chunks, from 0 to 1."""
+    return sum(1 for value, other_value in zip(signature, other) if value == other_value) / len(signature)
+
+def lsh_rows_per_band(threshold):
+    """Rows per band for locality-sensitive hashing, so pairs around the threshold still share a band.
+
+    Signatures are cut into bands of this many values, files that have one band
+    exactly the same become candidates. Pairs with a similarity of s share a
+    band with a probability of 1 - (1 - s ** rows) ** bands.
+    """
+    rows = 1
+    for candidate in (2, 4, 8, 16):
+        bands = MINHASH_BINS // candidate
+        if (1 / bands) ** (1 / candidate) <= threshold - 0.1:
+            rows = candidate
+    return rows
+
+
+def chunk_file(file_path):
+    """Digests (63 bits, so SQLite can store them) and lengths of a file's chunks."""
+    digests = array('q')
+    lengths = array('I')
+    with open(file_path, "rb") as f:
+        for chunk in iter_chunks(f):
+            digests.append(chunk_digest(chunk) >> 1)
+            lengths.append(len(chunk))
+    return digests, lengths
+
+
+class ChunkIndex:
+    """Chunk digests of many files in SQLite, to find byte ranges files have in common.
+
+    One row per distinct chunk of a file, with how often the file has it. The
+    index lives on disk and SQLite's cache is kept small, so memory stays
+    bounded however much data is chunked.
+    """
+    CACHE_KB = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # The index is rebuilt by every search, a crash only loses a scratch file
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute(f"PRAGMA cache_size = -{self.CACHE_KB}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (digest INTEGER, file INTEGER, length INTEGER, count INTEGER, "
+            "PRIMARY KEY (digest, file)) WITHOUT ROWID")
+        self.connection.commit()
+
+    def add_file(self, file_number, digests, lengths):
+        counts = collections.Counter(digests)
+        chunk_lengths = dict(zip(digests, lengths))
+        self.connection.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+                                    ((digest, file_number, chunk_lengths[digest], count) for digest, count in counts.items()))
+
+    def commit(self):
+        self.connection.commit()
+
+    def dedupe_estimate(self):
+        """(bytes chunked, bytes left if every chunk was stored once)."""
+        total, unique = self.connection.execute(
+            "SELECT sum(length * count), sum(length) FROM "
+            "(SELECT max(length) AS length, sum(count) AS count FROM chunks GROUP BY digest)").fetchone()
+        return total or 0, unique or 0
+
+    def shared_bytes(self, max_files_per_chunk=100):
+        """Yield (file, other file, bytes in common) for every pair of files with a chunk in common.
+
+        Chunks found in more than max_files_per_chunk files (runs of zeros and
+        the like) say little about two files and would make the pairs explode,
+        they are left out.
+        """
+        return self.connection.execute(
+            "SELECT a.file, b.file, sum(a.length * min(a.count, b.count)) FROM chunks a "
+            "JOIN chunks b ON a.digest = b.digest AND a.file < b.file "
+            "WHERE a.digest IN (SELECT digest FROM chunks GROUP BY digest HAVING count(*) BETWEEN 2 AND ?) "
+            "GROUP BY a.file, b.file", (max_files_per_chunk,))
+
+    def close(self):
+        self.connection.close()
+
+
+# Perceptual hashes of images: 64 bits that change little when an image is
+# resized or saved again at another quality, compared by Hamming distance.
+# Reading the images needs Pillow, which is only imported for this search.
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'tif', 'tiff', 'webp'}
+IMAGE_HASHES = ['ahash', 'dhash', 'phash']
+DEFAULT_IMAGE_HASH = 'dhash'
+DEFAULT_IMAGE_DISTANCE = 6  # Bits of 64 two images may differ by
+
+def pillow_available():
+    return importlib.util.find_spec("PIL") is not None
+
+def _image_pixels(file_path, width, height):
+    from PIL import Image
+    with Image.open(file_path) as image:
+        # JPEG can decode straight at a fraction of the size, much faster than decoding it all
+        image.draft('L', (width * 4, height * 4))
+        image = image.convert('L').resize((width, height), Image.BILINEAR)
+        return list(image.tobytes())
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bool(bit)
+    return value
+
+def image_hash(file_path, method=DEFAULT_IMAGE_HASH):
+    """64 bit perceptual hash of an image: 'ahash' (average), 'dhash' (gradient) or 'phash' (DCT)."""
+    if method == 'ahash':
+        pixels = _image_pixels(file_path, 8, 8)
+        average = sum(pixels) / len(pixels)
+        return _bits_to_int(pixel > average for pixel in pixels)
+    if method == 'dhash':
+        pixels = _image_pixels(file_path, 9, 8)
+        return _bits_to_int(pixels[row * 9 + column] < pixels[row * 9 + column + 1]
+                            for row in range(8) for column in range(8))
+    if method == 'phash':
+        size = 32
+        pixels = _image_pixels(file_path, size, size)
+        # Only the 8x8 lowest frequencies of the DCT are needed, one dimension at a time
+        cosines = [[math.cos((2 * x + 1) * u * math.pi / (2 * size)) for x in range(size)] for u in range(8)]
+        rows = [[sum(pixels[y * size + x] * cosines[u][x] for x in range(size)) for u in range(8)] for y in range(size)]
+        coefficients = [sum(rows[y][u] * cosines[v][y] for y in range(size)) for v in range(8) for u in range(8)]
+        # The first coefficient is the average brightness, it's left out of the median
+        median = sorted(coefficients[1:])[len(coefficients[1:]) // 2]
+        return _bits_to_int(coefficient > median for coefficient in coefficients)
+    raise ValueError(f"Unknown image hash {method}")
+
+def hamming_distance(value, other):
+    return bin(value ^ other).count("1")
+
+
+class BKTree:
+    """Finds the hashes within a Hamming distance of a hash without comparing it to all of them.
+
+    Each node keeps its children by their distance to it. The triangle
+    inequality means a search only has to visit the children whose distance
+    is within max_distance of the searched hash's distance to the node.
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """List of (distance, item) for every item within max_distance."""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+
+# Markers that file managers add to copies, like "photo (1).jpg" or "photo - Copy.jpg"
+COPY_MARKER = re.compile(r"(?: - copy(?: \(\d+\))?| copy(?: \d+)?| \(\d+\))+$")
+METADATA_KEYS = ['size', 'name', 'mtime', 'ctime']
+DEFAULT_DATE_TOLERANCE = 2  # Seconds, FAT file systems store modification times in 2 second steps
+
+def normalized_name(path):
+    """File name for matching by name: case, Unicode form and copy markers don't count."""
+    import unicodedata
+    name = unicodedata.normalize("NFKC", os.path.basename(path)).casefold()
+    stem, extension = os.path.splitext(name)
+    stem = COPY_MARKER.sub("", stem).strip()
+    if stem.startswith("copy of "):
+        stem = stem[len("copy of "):]
+    return stem + extension
+
+def split_by_time(files, field, tolerance_ns):
+    """Split files into runs whose times are at most tolerance_ns apart from the previous file."""
+    files = sorted(files, key=lambda entry: getattr(entry, field))
+    runs = [[files[0]]]
+    for previous, entry in zip(files, files[1:]):
+        if getattr(entry, field) - getattr(previous, field) > tolerance_ns:
+            runs.append([])
+        runs[-1].append(entry)
+    return runs
+
+def verify_groups(groups, hash_engine, hash_cache=None, workers=None, progress=None):
+    """Hash the files of unverified groups and split them into groups of identical files.
+
+    progress is called with (files hashed, total). Returns the new groups,
+    files that turn out to have no identical copy in their group are dropped.
+    """
+    jobs = []
+    zip_members = {}
+    for number, group in enumerate(groups):
+        for position, paths in enumerate(group.members):
+            if "_inside_zip/" in paths[0]:
+                zip_path, inner_file = paths[0].split("_inside_zip/", 1)
+                zip_members.setdefault(zip_path, []).append(((number, position), inner_file))
+                continue
+            try:
+                device = os.lstat(paths[0]).st_dev
+            except OSError:
+                device = 0
+            jobs.append(((number, position), device, cached_file_hash, (paths[0], hash_engine, hash_cache)))
+    # Each archive is opened once for all of its members
+    for zip_path, members in zip_members.items():
+        jobs.append((members, 0, hash_engine.hash_zip_members, (zip_path, [inner_file for key, inner_file in members])))
+
+    digests = {}
+    finished = 0
+    total = sum(len(group.members) for group in groups)
+    for key, result, error in HashWorkerPool(workers).run(jobs):
+        members = key if isinstance(key, list) else [(key, None)]
+        for member_key, inner_file in members:
+            finished += 1
+            if error is None:
+                digest = result.get(inner_file) if inner_file is not None else result
+                if digest is not None:
+                    digests[member_key] = digest
+        if progress is not None:
+            progress(finished, total)
+    if hash_cache is not None:
+        hash_cache.commit()
+
+    verified = []
+    for number, group in enumerate(groups):
+        sizes = group.size if isinstance(group.size, list) else [group.size] * len(group.members)
+        freeable = group.freeable or sizes
+        by_digest = {}
+        for position in range(len(group.members)):
+            if (number, position) in digests:
+                by_digest.setdefault((sizes[position], digests[(number, position)]), []).append(position)
+        for (size, digest), positions in by_digest.items():
+            if len(positions) > 1:
+                verified.append(DuplicateGroup(size, [group.members[position] for position in positions], digest=digest,
+                                               freeable=[freeable[position] for position in positions]))
+    return verified
+
+
+# Actions a batch can run on a file. target is the new path for 'move', the
+# file to link to for 'hardlink' (a move returns the path it really used), the members to remove for 'zip_delete' and
+# the copies to share the file's data with for 'reflink'. Only 'move' and
+# 'hardlink' can be undone. An action may return a result for the journal.
+def delete_action(path, target):
+    os.remove(path)
+
+def trash_action(path, target):
+    import send2trash  # Only needed when files are sent to the trash
+    send2trash.send2trash(path)
+
+def move_file(path, target):
+    # A rename on the same drive, to another drive the file is copied and then deleted
+    import shutil
+    try:
+        os.replace(path, target)
+    except OSError:
+        shutil.move(path, target)
+
+def move_action(path, target):
+    """Move path to target, or to "name (2).ext" and so on when that name is taken. Returns the new path."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    stem, extension = os.path.splitext(target)
+    number = 1
+    while True:
+        try:
+            # Creating the file claims the name, so two files moved at once never pick the same one
+            os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            number += 1
+            target = f"{stem} ({number}){extension}"
+    try:
+        move_file(path, target)
+    except BaseException:
+        if os.path.lexists(path):
+            os.remove(target)  # Only the claimed name or a partial copy, the file is still where it was
+        raise
+    return target
+
+def hardlink_action(path, target):
+    # The link is made next to the file and renamed over it, so the file is never missing
+    temp_path = path + ".dfflink"
+    os.link(target, temp_path)
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+# Linux ioctl for sharing identical ranges of files (FIDEDUPERANGE). The kernel
+# compares the bytes itself and only shares extents that really are the same
+FIDEDUPERANGE = 0xC0189436
+DEDUPE_CHUNK_SIZE = 16 * 1024 * 1024  # btrfs dedupes at most 16 MiB per call
+DEDUPE_MAX_TARGETS = 120  # The request has to fit in one page
+FILE_DEDUPE_RANGE_DIFFERS = 1
+
+def reflink_action(path, target):
+    """Share the data of path with the files in target['targets'] in place.
+
+    The files stay separate copies, a change to one doesn't show in the
+    others. Works on filesystems with shared extents like btrfs and XFS.
+    Returns the bytes now shared, per file.
+    """
+    import errno
+    import struct
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "Sharing data between files needs Linux")
+
+    size = os.path.getsize(path)
+    deduped = {}
+    with open(path, "rb") as source:
+        for start in range(0, len(target['targets']), DEDUPE_MAX_TARGETS):
+            batch = target['targets'][start:start + DEDUPE_MAX_TARGETS]
+            # Opened read only, the kernel allows it for files the user owns
+            files = [open(other, "rb") for other in batch]
+            try:
+                for other, other_file in zip(batch, files):
+                    if os.fstat(other_file.fileno()).st_size != size:
+                        raise OSError(f"{other} is not the same size as {path}")
+                    deduped[other] = 0
+                offset = 0
+                while offset < size:
+                    length = min(DEDUPE_CHUNK_SIZE, size - offset)
+                    request = bytearray(struct.pack("=QQHHI", offset, length, len(files), 0, 0))
+                    for other_file in files:
+                        request += struct.pack("=qQQiI", other_file.fileno(), offset, 0, 0, 0)
+                    try:
+                        fcntl.ioctl(source.fileno(), FIDEDUPERANGE, request, True)
+                    except OSError as error:
+                        if error.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV):
+                            raise OSError(error.errno, f"The filesystem of {path} can't share data between files "
+                                                       f"(only btrfs, XFS and similar can): {error.strerror}")
+                        raise
+                    for number, other in enumerate(batch):
+                        dest_fd, dest_offset, bytes_deduped, status, reserved = struct.unpack_from(
+                            "=qQQiI", request, 24 + 32 * number)
+                        if status == FILE_DEDUPE_RANGE_DIFFERS:
+                            raise OSError(f"{other} is no longer the same as {path}")
+                        if status < 0:
+                            raise OSError(-status, f"{other}: {os.strerror(-status)}")
+                        deduped[other] += bytes_deduped
+                    offset += length
+            finally:
+                for other_file in files:
+                    other_file.close()
+    return deduped
+
+def remove_zip_members(zip_path, members):
+    """Rewrite a ZIP file without the given members in one pass.
+
+    The members that stay are copied as they are, compressed data and all, so
+    nothing is recompressed. The new archive is written next to the old one
+    and renamed over it, the old archive is untouched if anything goes wrong.
+    """
+    import zipfile
+    import shutil
+    import struct
+    members = set(members)
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        infos = zip_ref.infolist()
+        start_dir = zip_ref.start_dir
+        comment = zip_ref.comment
+    missing = members - {info.filename for info in infos}
+    if missing:
+        raise KeyError(f"not in {zip_path}: {', '.join(sorted(missing))}")
+
+    # A member's local header, data and data descriptor run up to the next member or the central directory
+    starts = sorted({info.header_offset for info in infos}) + [start_dir]
+    span_end = dict(zip(starts, starts[1:]))
+
+    temp_path = zip_path + ".dffzip"
+    try:
+        with open(zip_path, "rb") as src, open(temp_path, "wb") as dst:
+            src.seek(start_dir)
+            records = []
+            for info in infos:
+                header = src.read(zipfile.sizeCentralDir)
+                fields = struct.unpack(zipfile.structCentralDir, header)
+                rest = src.read(fields[zipfile._CD_FILENAME_LENGTH] + fields[zipfile._CD_EXTRA_FIELD_LENGTH]
+                                + fields[zipfile._CD_COMMENT_LENGTH])
+                records.append((info, bytearray(header + rest), fields))
+
+            # Anything before the first member, like a self-extractor, stays in front
+            copy_range(src, dst, 0, starts[0])
+            shifts = {}
+            for info, record, fields in sorted(records, key=lambda item: item[0].header_offset):
+                if info.filename in members:
+                    continue
+                shifts[id(info)] = info.header_offset - dst.tell()
+                copy_range(src, dst, info.header_offset, span_end[info.header_offset])
+
+            cd_start = dst.tell()
+            count = 0
+            # Offsets in the archive don't count the bytes in front of it
+            prefix = 0
+            for info, record, fields in records:
+                stored_offset = central_dir_offset(record, fields)
+                prefix = info.header_offset - stored_offset
+                if id(info) not in shifts:
+                    continue
+                set_central_dir_offset(record, fields, stored_offset - shifts[id(info)])
+                dst.write(record)
+                count += 1
+            cd_size = dst.tell() - cd_start
+            cd_offset = cd_start - prefix
+
+            if count > 0xFFFF or cd_size > 0xFFFFFFFF or cd_offset > 0xFFFFFFFF:
+                zip64_offset = dst.tell() - prefix
+                dst.write(struct.pack(zipfile.structEndArchive64, zipfile.stringEndArchive64,
+                                      44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+                dst.write(struct.pack(zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator,
+                                      0, zip64_offset, 1))
+                count = min(count, 0xFFFF)
+                cd_size = min(cd_size, 0xFFFFFFFF)
+                cd_offset = min(cd_offset, 0xFFFFFFFF)
+            dst.write(struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive,
+                                  0, 0, count, count, cd_size, cd_offset, len(comment)))
+            dst.write(comment)
+            dst.flush()
+            os.fsync(dst.fileno())
+        shutil.copymode(zip_path, temp_path)
+        os.replace(temp_path, zip_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def copy_range(src, dst, start, end, block_size=1024 * 1024):
+    src.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = src.read(min(block_size, remaining))
+        if not data:
+            raise EOFError("archive is shorter than its central directory says")
+        dst.write(data)
+        remaining -= len(data)
+
+def zip64_offset_position(record, fields):
+    # Big archives keep the offset in the zip64 extra field, after the sizes that didn't fit
+    import struct
+    import zipfile
+    extra_start = zipfile.sizeCentralDir + fields[zipfile._CD_FILENAME_LENGTH]
+    extra_end = extra_start + fields[zipfile._CD_EXTRA_FIELD_LENGTH]
+    position = extra_start
+    while position + 4 <= extra_end:
+        field_id, field_size = struct.unpack("<HH", record[position:position + 4])
+        if field_id == 1:
+            skip = 8 * sum(1 for index in (zipfile._CD_UNCOMPRESSED_SIZE, zipfile._CD_COMPRESSED_SIZE)
+                           if fields[index] == 0xFFFFFFFF)
+            return position + 4 + skip
+        position += 4 + field_size
+    raise ValueError("zip64 extra field is missing")
+
+def central_dir_offset(record, fields):
+    import struct
+    import zipfile
+    offset = fields[zipfile._CD_LOCAL_HEADER_OFFSET]
+    if offset == 0xFFFFFFFF:
+        position = zip64_offset_position(record, fields)
+        offset = struct.unpack("<Q", record[position:position + 8])[0]
+    return offset
+
+def set_central_dir_offset(record, fields, offset):
+    import struct
+    import zipfile
+    if fields[zipfile._CD_LOCAL_HEADER_OFFSET] == 0xFFFFFFFF:
+        position = zip64_offset_position(record, fields)
+        record[position:position + 8] = struct.pack("<Q", offset)
+    else:
+        # Offsets only get smaller, so one that fitted before still fits
+        record[42:46] = struct.pack("<L", offset)
+
+def zip_delete_action(path, target):
+    # path is the archive, target lists the members to take out of it. With
+    # 7-Zip set up it does the work, otherwise the archive is rewritten here
+    seven_zip = target.get('seven_zip')
+    if not seven_zip:
+        remove_zip_members(path, target['members'])
+        return
+    import subprocess
+    import tempfile
+    # The member names go in a list file, a big batch doesn't fit on one command line
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", encoding="utf-8", delete=False) as list_file:
+        list_file.write("\n".join(target['members']) + "\n")
+    try:
+        subprocess.run([seven_zip, 'd', '-scsUTF-8', path, f"@{list_file.name}"], check=True, capture_output=True)
+    finally:
+        os.remove(list_file.name)
+
+def undo_move_action(path, target):
+    if os.path.lexists(path):
+        raise FileExistsError(f"{path} already exists")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    move_file(target, path)
+
+def undo_hardlink_action(path, target):
+    # The content is the same, so a separate copy of the linked file brings the file back
+    import shutil
+    temp_path = path + ".dffcopy"
+    shutil.copy2(target, temp_path)
+    os.replace(temp_path, path)
+
+BATCH_ACTIONS = {
+    'delete': delete_action,
+    'trash': trash_action,
+    'move': move_action,
+    'hardlink': hardlink_action,
+    'zip_delete': zip_delete_action,
+    'reflink': reflink_action,
+}
+UNDO_ACTIONS = {
+    'move': undo_move_action,
+    'hardlink': undo_hardlink_action,
+}
+
+
+class BatchJournal:
+    """Append-only record of a batch of file actions, one JSON object per line.
+
+    The first line describes the batch and the next ones list every planned
+    action. The outcome of each action is appended as it happens, so a batch
+    that was interrupted can be resumed, and the done moves and hardlinks of a
+    batch can be undone.
+    """
+    SYNC_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.items = []  # (action, path, target)
+        self.status = {}  # item number -> 'done', 'error' or 'undone'
+        self.errors = {}  # item number -> error message
+        self.results = {}  # item number -> what the action returned, like the bytes a reflink shared
+        self.file = None
+        self.unsynced = 0
+        self.torn_line = False
+        if os.path.exists(path):
+            self.load()
+
+    @classmethod
+    def create(cls, items, directory=None):
+        """Start a journal for a list of (action, path, target)."""
+        directory = directory or get_journal_dir()
+        os.makedirs(directory, exist_ok=True)
+        journal = cls(os.path.join(directory, f"batch-{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 1000000:06d}.jsonl"))
+        lines = [json.dumps({'created': time.time(), 'items': len(items)})]
+        for number, (action, path, target) in enumerate(items):
+            lines.append(json.dumps({'item': number, 'action': action, 'path': path, 'target': target}))
+            journal.items.append((action, path, target))
+        # The whole plan is on disk before the first file is touched
+        journal.file = open(journal.path, "a", encoding="utf-8")
+        journal.file.write("\n".join(lines) + "\n")
+        journal.sync()
+        return journal
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                self.torn_line = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by a crash
+                if 'action' in record:
+                    self.items.append((record['action'], record['path'], record['target']))
+                elif 'status' in record:
+                    self.status[record['item']] = record['status']
+                    if record.get('error'):
+                        self.errors[record['item']] = record['error']
+                    if record.get('result') is not None:
+                        self.results[record['item']] = record['result']
+
+    def append(self, record):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            if self.torn_line:
+                # Start after the line a crash cut short, not in the middle of it
+                self.file.write("\n")
+                self.torn_line = False
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.SYNC_EVERY:
+            self.sync()
+
+    def record(self, number, status, error=None, result=None):
+        self.status[number] = status
+        record = {'item': number, 'status': status, 'error': error}
+        if error is not None:
+            self.errors[number] = error
+        if result is not None:
+            self.results[number] = record['result'] = result
+        self.append(record)
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def pending(self):
+        """Numbers of the items that never got an outcome."""
+        return [number for number in range(len(self.items)) if number not in self.status]
+
+    def undoable(self):
+        return [number for number in range(len(self.items))
+                if self.status.get(number) in ('done', 'undo_error') and self.items[number][0] in UNDO_ACTIONS]
+
+# Finished journals kept for undo and for looking up errors, older ones are deleted
+JOURNALS_KEPT = 20
+
+def get_journal_dir():
+    return os.path.join(get_config_dir(), "journal")
+
+def journal_paths(directory):
+    # Newest first, the names start with the time the batch was planned
+    return sorted((os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.startswith("batch-") and name.endswith(".jsonl")), reverse=True)
+
+def prune_journals(directory=None, keep=JOURNALS_KEPT):
+    """Delete finished journals beyond the newest keep ones. Unfinished journals stay until resumed."""
+    directory = directory or get_journal_dir()
+    if not os.path.isdir(directory):
+        return
+    for path in journal_paths(directory)[keep:]:
+        try:
+            if not BatchJournal(path).pending():
+                os.remove(path)
+        except OSError:
+            pass
+
+def unfinished_journals(directory=None):
+    """Journals of batches that stopped before every action was tried, newest first."""
+    directory = directory or get_journal_dir()
+    if not os.path.isdir(directory):
+        return []
+    return [path for path in journal_paths(directory) if BatchJournal(path).pending()]
+
+def latest_undoable_journal(directory=None):
+    """The newest journal with moves or hardlinks left to undo, or None."""
+    directory = directory or get_journal_dir()
+    if not os.path.isdir(directory):
+        return None
+    for path in journal_paths(directory):
+        if BatchJournal(path).undoable():
+            return path
+    return None
+
+def run_batch(journal, undo=False, workers=None, per_device=None, progress=None):
+    """Run the pending actions of a journal, or undo its done ones, on a pool of threads.
+
+    Files are queued per device like the hashing, so a spinning disk gets one
+    action at a time. Every outcome goes to the journal as it happens.
+    progress is called with (actions finished, total). Returns the item numbers
+    that succeeded and a list of (path, error message) for the ones that failed.
+    """
+    numbers = journal.undoable() if undo else journal.pending()
+    jobs = []
+    for number in numbers:
+        action, path, target = journal.items[number]
+        if undo and action == 'move':
+            target = journal.results.get(number, target)  # The name the file got if the planned one was taken
+        # Queued by the device of the file the action changes
+        changed_path = target if undo and action == 'move' else path
+        try:
+            device = os.lstat(changed_path.split("_inside_zip/", 1)[0]).st_dev
+        except OSError:
+            device = 0
+        function = UNDO_ACTIONS[action] if undo else BATCH_ACTIONS[action]
+        jobs.append((number, device, function, (path, target)))
+
+    succeeded = []
+    errors = []
+    last_progress = 0
+    # The pool is shared with hashing, here it runs file actions instead of hashes
+    pool = HashWorkerPool(workers, False, per_device)
+    try:
+        for finished, (number, result, error) in enumerate(pool.run(jobs), 1):
+            if error is None:
+                journal.record(number, 'undone' if undo else 'done', result=result)
+                succeeded.append(number)
+            else:
+                journal.record(number, 'undo_error' if undo else 'error', str(error))
+                errors.append((journal.items[number][1], str(error)))
+            now = time.monotonic()
+            if progress is not None and (finished == len(jobs) or now - last_progress >= 0.2):
+                progress(finished, len(jobs))
+                last_progress = now
+    finally:
+        journal.close()
+    # A journal is only kept while it can be resumed or undone, or lists errors
+    if not journal.pending() and not journal.undoable() and not errors:
+        try:
+            os.remove(journal.path)
+        except OSError:
+            pass
+    prune_journals(os.path.dirname(journal.path))
+    return succeeded, errors
+
+
+# A group of identical files: the size of each file (a list with one size per
+# file for similar files) and, per file, the list of paths that are hardlinks of it. similarity is an optional percent per file,
+# digest the content hash and freeable the bytes deleting each file frees
+# (None when it has hardlinks outside the results). unverified groups were
+# matched on metadata only, their content was never compared.
+DuplicateGroup = collections.namedtuple('DuplicateGroup', ['size', 'members', 'similarity', 'digest', 'freeable', 'unverified'], defaults=(None, None, None, False))
+
+
+class DuplicateIndex:
+    """Search results kept column by column, one row per file, with lookups by group, digest and path.
+
+    Rows never move: a removed row is only marked dead, so a row number stays
+    valid for the model, the selection and any bookkeeping that kept it. The
+    file count, group count and reclaimable bytes are running totals, so a
+    delete, move or link only updates the group it touches and never reads a file.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.links = {}  # row -> the file's other hardlinks
+        self.group_ids = array('q')
+        self.sizes = array('q')
+        self.similarity = array('d')  # NaN when there is no percentage
+        self.freeable = array('q')  # -1 when deleting the file frees nothing
+        self.alive = bytearray()
+        self.group_rows = {}  # group id -> alive rows of the group
+        self.group_digests = {}  # group id -> digest
+        self.digest_groups = {}  # digest -> group id
+        self.path_rows = {}  # path, hardlinks included -> row
+        self.group_reclaimable = {}  # group id -> bytes freed by keeping one file
+        self.unverified = set()  # ids of the groups matched on metadata only
+        self.next_group_id = 1
+        self.file_count = 0
+        self.reclaimable_bytes = 0
+
+    def add_group(self, group):
+        group_id = self.next_group_id
+        self.next_group_id += 1
+        rows = []
+        for i, paths in enumerate(group.members):
+            row = len(self.paths)
+            self.paths.append(paths[0])
+            if len(paths) > 1:
+                self.links[row] = paths[1:]
+            for path in paths:
+                self.path_rows[path] = row
+            self.group_ids.append(group_id)
+            size = group.size[i] if isinstance(group.size, list) else group.size
+            self.sizes.append(size)
+            self.similarity.append(group.similarity[i] if group.similarity is not None else math.nan)
+            if group.freeable is not None:
+                self.freeable.append(-1 if group.freeable[i] is None else group.freeable[i])
+            else:
+                self.freeable.append(size)
+            self.alive.append(1)
+            rows.append(row)
+        self.group_rows[group_id] = rows
+        if group.unverified:
+            self.unverified.add(group_id)
+        if group.digest is not None:
+            self.group_digests[group_id] = group.digest
+            self.digest_groups[group.digest] = group_id
+        self.file_count += len(rows)
+        self.update_reclaimable(group_id)
+        return group_id
+
+    def remove_row(self, row):
+        """Mark a row as removed and return its group id, the group is dropped once it's empty."""
+        group_id = self._drop_row(row)
+        self.update_reclaimable(group_id)
+        return group_id
+
+    def _drop_row(self, row):
+        # remove_row() without updating the reclaimable bytes
+        group_id = self.group_ids[row]
+        if self.alive[row]:
+            self.alive[row] = 0
+            self.file_count -= 1
+            for path in self.all_paths(row):
+                if self.path_rows.get(path) == row:
+                    del self.path_rows[path]
+            self.group_rows[group_id].remove(row)
+            if not self.group_rows[group_id]:
+                del self.group_rows[group_id]
+                self.unverified.discard(group_id)
+                digest = self.group_digests.pop(group_id, None)
+                if self.digest_groups.get(digest) == group_id:
+                    del self.digest_groups[digest]
+        return group_id
+
+    def update_reclaimable(self, group_id):
+        rows = self.group_rows.get(group_id, [])
+        reclaimable = group_reclaimable_bytes([None if self.freeable[row] < 0 else self.freeable[row] for row in rows])
+        self.reclaimable_bytes += reclaimable - self.group_reclaimable.get(group_id, 0)
+        if rows:
+            self.group_reclaimable[group_id] = reclaimable
+        else:
+            self.group_reclaimable.pop(group_id, None)
+
+    def remove_group(self, group_id):
+        for row in list(self.group_rows.get(group_id, [])):
+            self._drop_row(row)
+        self.update_reclaimable(group_id)
+
+    def remove_rows(self, rows):
+        """Remove files, and the rest of any group left with a single file. Returns the groups touched."""
+        touched = set()
+        for row in rows:
+            touched.add(self._drop_row(row))
+        for group_id in touched:
+            if len(self.group_rows.get(group_id, [])) < 2:
+                self.remove_group(group_id)
+            else:
+                self.update_reclaimable(group_id)
+        return touched
+
+    def group(self, group_id):
+        """The files of a group as a DuplicateGroup, for example to verify it with verify_groups()."""
+        rows = self.group_rows.get(group_id, [])
+        return DuplicateGroup([self.sizes[row] for row in rows], [self.all_paths(row) for row in rows],
+                              freeable=[None if self.freeable[row] < 0 else self.freeable[row] for row in rows],
+                              unverified=group_id in self.unverified)
+
+    def identical(self, group_id):
+        # Only groups confirmed by a hash have a digest, similar and metadata-only groups don't
+        return group_id in self.group_digests
+
+    def group_of_path(self, path):
+        row = self.path_rows.get(path)
+        return self.group_ids[row] if row is not None else None
+
+    def group_of_digest(self, digest):
+        return self.digest_groups.get(digest)
+
+    def rows(self):
+        for rows in self.group_rows.values():
+            yield from rows
+
+    def group_count(self):
+        return len(self.group_rows)
+
+    def path(self, row):
+        return self.paths[row]
+
+    def all_paths(self, row):
+        return [self.paths[row]] + self.links.get(row, [])
+
+    def filename(self, row):
+        return os.path.basename(self.paths[row])
+
+    def folder(self, row):
+        return os.path.dirname(self.paths[row])
+
+    def sort_key(self, row, column):
+        # Native values, so sorting never parses display text
+        if column == 0:
+            return self.filename(row).lower()
+        if column == 1:
+            return self.group_ids[row]
+        if column == 2:
+            return self.folder(row).lower()
+        if column == 3:
+            return self.sizes[row]
+        similarity = self.similarity[row]
+        return -1.0 if math.isnan(similarity) else similarity
+
+    def export_rows(self, group_order=None):
+        """Yield one row of EXPORT_HEADERS values per file, group by group.
+
+        Only the list of group ids is copied, the rows are read as they are
+        written, so memory use doesn't grow with the number of files.
+        """
+        for group_id in list(group_order if group_order is not None else self.group_rows):
+            for row in list(self.group_rows.get(group_id, [])):
+                similarity = self.similarity[row]
+                yield [group_id, self.filename(row), self.folder(row), self.sizes[row],
+                       None if math.isnan(similarity) else similarity, "; ".join(self.links.get(row, [])),
+                       "yes" if group_id in self.unverified else ""]
+
+
+# Columns of an exported result file
+EXPORT_HEADERS = ["Duplicate ID", "Filename", "File Path", "File Size (bytes)", "Percent Similar", "Hardlinks", "Unverified"]
+EXPORT_FORMATS = ['xlsx', 'csv', 'jsonl']
+
+def export_results(store, path, export_format=None, group_order=None, progress=None, progress_every=10000):
+    """Write the files of a DuplicateIndex to path as XLSX, CSV or JSON Lines.
+
+    Rows are streamed one at a time; XLSX uses openpyxl's write-only mode, so a
+    million-row export needs no more memory than a small one. progress is called
+    with (rows written, total rows) every progress_every rows and at the end.
+    Returns the number of rows written.
+    """
+    export_format = export_format or os.path.splitext(path)[1][1:].lower()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    total = store.file_count
+    written = 0
+
+    def rows():
+        nonlocal written
+        for values in store.export_rows(group_order):
+            yield values
+            written += 1
+            if progress is not None and written % progress_every == 0:
+                progress(written, total)
+
+    if export_format == 'xlsx':
+        from openpyxl import Workbook  # Only needed for exports
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Duplicates")
+        header = []
+        for title in EXPORT_HEADERS:
+            cell = WriteOnlyCell(sheet, value=title)
+            cell.font = Font(bold=True)
+            header.append(cell)
+        sheet.append(header)
+
+        def cell_text(value):
+            # Control characters and undecodable bytes are allowed in file names but not in an XLSX cell
+            value = value.encode("utf-8", "backslashreplace").decode("utf-8")
+            return ILLEGAL_CHARACTERS_RE.sub("?", value)
+
+        for values in rows():
+            sheet.append([cell_text(value) if isinstance(value, str) else value for value in values])
+        workbook.save(path)
+    else:
+        # File names that aren't valid UTF-8 are written with their odd bytes escaped instead of failing
+        with open(path, "w", newline="", encoding="utf-8", errors="backslashreplace") as f:
+            if export_format == 'csv':
+                writer = csv.writer(f)
+                writer.writerow(EXPORT_HEADERS)
+                writer.writerows(rows())
+            else:
+                for values in rows():
+                    f.write(json.dumps(dict(zip(EXPORT_HEADERS, values))) + "\n")
+
+    if progress is not None:
+        progress(written, total)
+    return written
+
+
+class GroupWriter:
+    """Writes duplicate groups to a file as they come in, as text, CSV or JSON lines."""
+    FORMATS = ['text', 'csv', 'jsonl']
+
+    def __init__(self, output, output_format='text'):
+        self.output = output
+        self.output_format = output_format
+        self.group_count = 0
+        if output_format == 'csv':
+            self.csv_writer = csv.writer(output)
+            self.csv_writer.writerow(["Duplicate ID", "File Size", "File Path", "Hardlink Of", "Percent Similar", "Unverified"])
+
+    def write_groups(self, groups):
+        for group in groups:
+            self.group_count += 1
+            # Similar files have a size and a percentage each
+            sizes = group.size if isinstance(group.size, list) else [group.size] * len(group.members)
+            similarity = group.similarity or [None] * len(group.members)
+            unverified = "yes" if group.unverified else ""
+            if self.output_format == 'csv':
+                for paths, size, percent in zip(group.members, sizes, similarity):
+                    self.csv_writer.writerow([self.group_count, size, paths[0], "", "" if percent is None else f"{percent:.1f}", unverified])
+                    for link in paths[1:]:
+                        self.csv_writer.writerow([self.group_count, size, link, paths[0], "" if percent is None else f"{percent:.1f}", unverified])
+            elif self.output_format == 'jsonl':
+                record = {'id': self.group_count, 'size': group.size, 'files': group.members}
+                if group.similarity is not None:
+                    record['similarity'] = group.similarity
+                if group.unverified:
+                    record['unverified'] = True
+                self.output.write(json.dumps(record) + "\n")
+            elif group.unverified:
+                # Matched on metadata only, the contents were never compared
+                if isinstance(group.size, list):
+                    self.output.write(f"Possible duplicate {self.group_count} (unverified):\n")
+                    for paths, size in zip(group.members, sizes):
+                        self.output.write(f"  {paths[0]} ({format_size(size)})\n")
+                        for link in paths[1:]:
+                            self.output.write(f"    hardlink: {link}\n")
+                else:
+                    self.output.write(f"Possible duplicate {self.group_count} (unverified), {format_size(group.size)} each:\n")
+                    for paths in group.members:
+                        self.output.write(f"  {paths[0]}\n")
+                        for link in paths[1:]:
+                            self.output.write(f"    hardlink: {link}\n")
+                self.output.write("\n")
+            elif group.similarity is not None:
+                self.output.write(f"Similar files {self.group_count}:\n")
+                for paths, size, percent in zip(group.members, sizes, similarity):
+                    self.output.write(f"  {paths[0]} ({format_size(size)}, {percent:.0f}% similar)\n")
+                    for link in paths[1:]:
+                        self.output.write(f"    hardlink: {link}\n")
+                self.output.write("\n")
+            else:
+                self.output.write(f"Duplicate {self.group_count}, {format_size(group.size)} each:\n")
+                for paths in group.members:
+                    self.output.write(f"  {paths[0]}\n")
+                    for link in paths[1:]:
+                        self.output.write(f"    hardlink: {link}\n")
+                self.output.write("\n")
+        self.output.flush()
+
+
+def parse_extensions(text):
+    # "jpg, .PNG" -> ['jpg', 'png'], the search compares lowercase extensions without the dot
+    return [ext.strip().lstrip('.').lower() for ext in text.split(",") if ext.strip()] if text else []
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Find duplicate files without starting the GUI.")
+    parser.add_argument("directories", nargs="*", help="folders to search")
+    parser.add_argument("--min-size", type=int, default=0, help="smallest file size in KB (default 0)")
+    parser.add_argument("--max-size", type=int, default=sys.maxsize, help="largest file size in KB")
+    parser.add_argument("--extensions", default="", help="only search these extensions, comma separated")
+    parser.add_argument("--skip-extensions", default="", help="skip these extensions, comma separated")
+    parser.add_argument("--zip", action="store_true", help="search inside ZIP files")
+    parser.add_argument("--modified-from", metavar="DATE", help="only search files modified on or after DATE (YYYY-MM-DD)")
+    parser.add_argument("--modified-until", metavar="DATE", help="only search files modified on or before DATE (YYYY-MM-DD)")
+    parser.add_argument("--similar", metavar="PERCENT", type=int,
+                        help="find files that share at least PERCENT percent of their content instead of identical files")
+    parser.add_argument("--shared-blocks", metavar="PERCENT", type=int,
+                        help="find files that have at least PERCENT percent of their bytes in common, from an index "
+                             "of content-defined chunks, and estimate what block-level deduplication would save")
+    parser.add_argument("--images", metavar="HASH", nargs="?", const=DEFAULT_IMAGE_HASH, choices=IMAGE_HASHES,
+                        help=f"find images that look the same with a perceptual hash (default {DEFAULT_IMAGE_HASH}), needs Pillow")
+    parser.add_argument("--max-distance", type=int, default=DEFAULT_IMAGE_DISTANCE,
+                        help=f"bits of 64 two image hashes may differ by (default {DEFAULT_IMAGE_DISTANCE})")
+    parser.add_argument("--metadata", metavar="KEYS",
+                        help="match files on KEYS alone without reading them, comma separated from "
+                             f"{', '.join(METADATA_KEYS)}; the results are unverified")
+    parser.add_argument("--date-tolerance", metavar="SECONDS", type=float, default=DEFAULT_DATE_TOLERANCE,
+                        help=f"seconds two dates may differ by with --metadata (default {DEFAULT_DATE_TOLERANCE})")
+    parser.add_argument("--verify", action="store_true", help="hash the groups found by --metadata and only report identical files")
+    parser.add_argument("--cross-only", action="store_true",
+                        help="only compare files in different folders, not files within the same folder")
+    parser.add_argument("--algorithm", default=DEFAULT_HASH_ALGORITHM, choices=available_hash_algorithms() + ['auto'],
+                        help=f"hash algorithm (default {DEFAULT_HASH_ALGORITHM})")
+    parser.add_argument("--workers", type=int, default=None, help="number of hashing workers")
+    parser.add_argument("--processes", action="store_true", help="hash in worker processes instead of threads")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or update the hash cache")
+    parser.add_argument("--build-index", metavar="INDEX",
+                        help="save the size and digest of every file under the folders to INDEX instead of searching, "
+                             "an existing index is updated")
+    parser.add_argument("--index", metavar="INDEX", help="also check the folders against the library saved in INDEX")
+    parser.add_argument("--format", default="text", choices=GroupWriter.FORMATS, help="output format (default text)")
+    parser.add_argument("--output", "-o", help="write the results to this file instead of standard output")
+    parser.add_argument("--quiet", "-q", action="store_true", help="don't show progress")
+    parser.add_argument("--resume", metavar="JOURNAL", nargs="?", const="",
+                        help="run the actions an interrupted batch never got to, the newest one if no journal is given")
+    parser.add_argument("--undo", metavar="JOURNAL", nargs="?", const="",
+                        help="undo the moves and hardlinks of a batch, the newest one if no journal is given")
+    args = parser.parse_args(argv)
+
+    if args.resume is not None or args.undo is not None:
+        undo = args.undo is not None
+        journal_path = args.undo if undo else args.resume
+        if not journal_path:
+            journal_path = latest_undoable_journal() if undo else next(iter(unfinished_journals()), None)
+        if not journal_path:
+            print("Nothing to undo." if undo else "No unfinished batch.", file=sys.stderr)
+            return 1
+        succeeded, errors = run_batch(BatchJournal(journal_path), undo, args.workers)
+        for path, error in errors:
+            print(f"{path}: {error}", file=sys.stderr)
+        print(f"{'Undid' if undo else 'Ran'} {len(succeeded)} actions, {len(errors)} failed ({journal_path})", file=sys.stderr)
+        return 1 if errors else 0
+    if not args.directories:
+        parser.error("give at least one folder to search")
+    if args.images and not pillow_available():
+        parser.error("--images needs Pillow: pip install Pillow")
+    for option, percent in (("--similar", args.similar), ("--shared-blocks", args.shared_blocks)):
+        if percent is not None and not 0 < percent <= 100:
+            parser.error(f"{option} takes a percentage from 1 to 100")
+    if args.index and not os.path.isfile(args.index):
+        parser.error(f"reference index {args.index} does not exist")
+    metadata_keys = [key.strip().lower() for key in args.metadata.split(",") if key.strip()] if args.metadata else []
+    if args.metadata is not None and (not metadata_keys or set(metadata_keys) - set(METADATA_KEYS)):
+        parser.error(f"--metadata takes a comma separated list of {', '.join(METADATA_KEYS)}")
+    if args.verify and args.metadata is None:
+        parser.error("--verify only applies to --metadata")
+    try:
+        modified_from = parse_date(args.modified_from) if args.modified_from else None
+        modified_until = parse_date(args.modified_until, end_of_day=True) if args.modified_until else None
+    except ValueError:
+        parser.error("dates are written YYYY-MM-DD")
+
+    search_criteria = {
+        'min_file_size': args.min_size,
+        'max_file_size': args.max_size,
+        'file_extensions': parse_extensions(args.extensions),
+        'skip_extensions': parse_extensions(args.skip_extensions),
+        'search_inside_zip': args.zip,
+        'modified_from': modified_from,
+        'modified_until': modified_until,
+        'hash_workers': args.workers,
+        'use_processes': args.processes,
+        'hash_algorithm': args.algorithm,
+        'reference_index': args.index,
+        'match_mode': ('metadata' if metadata_keys else 'similar' if args.similar else 'blocks' if args.shared_blocks
+                       else 'images' if args.images else 'hash'),
+        'metadata_keys': metadata_keys,
+        'date_tolerance': args.date_tolerance,
+        'image_hash': args.images or DEFAULT_IMAGE_HASH,
+        'image_distance': args.max_distance,
+        'percent_similar': args.similar or args.shared_blocks or 100,
+    }
+
+    hash_cache = None
+    if not args.no_cache:
+        try:
+            hash_cache = HashCache()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Hash cache disabled: {e}", file=sys.stderr)
+
+    def show_progress(progress):
+        # Progress goes to stderr so it never mixes with the results
+        end = "\n" if progress['stage'] == 'done' else ""
+        print("\r" + format_progress(progress).ljust(100), end=end, file=sys.stderr, flush=True)
+
+    if args.build_index:
+        try:
+            reference = ReferenceIndex(args.build_index)
+            try:
+                stats = reference.build([os.path.abspath(directory) for directory in args.directories], args.algorithm,
+                                        hash_cache, args.workers, None if args.quiet else show_progress)
+                file_count = reference.file_count()
+            finally:
+                reference.close()
+        except (ValueError, sqlite3.Error) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        finally:
+            if hash_cache is not None:
+                hash_cache.close()
+        print(f"{file_count} files in {args.build_index} ({stats['algorithm']}): {stats['hashed']} hashed, "
+              f"{stats['unchanged']} unchanged, {stats['removed']} removed, {stats['errors']} errors", file=sys.stderr)
+        return 0
+
+    output = open(args.output, "w", newline="", encoding="utf-8", errors="backslashreplace") if args.output else sys.stdout
+    try:
+        writer = GroupWriter(output, args.format)
+        stats = {}
+        # Groups to verify are held back until the scan is done, everything else is written as it is found
+        on_groups = None if args.verify else writer.write_groups
+        scanner = DuplicateScanner([(os.path.abspath(directory), not args.cross_only) for directory in args.directories], search_criteria,
+                                   hash_cache, None if args.quiet else show_progress, stats.update, on_groups)
+        duplicates = scanner.run()
+        if args.verify:
+            def show_verified(finished, total):
+                print(f"\rVerifying: {finished} of {total} files hashed".ljust(100), end="", file=sys.stderr, flush=True)
+
+            groups = verify_groups(duplicates, scanner.hash_engine, hash_cache, args.workers,
+                                   None if args.quiet else show_verified)
+            if not args.quiet:
+                print(file=sys.stderr)
+            writer.write_groups(groups)
+            stats['duplicate_files'] = sum(len(group.members) for group in groups)
+            stats['reclaimable_bytes'] = sum(group_reclaimable_bytes(group.freeable) for group in groups)
+    except (ValueError, sqlite3.Error) as e:
+        # A bad reference index or hash cache, not a bug worth a traceback
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if hash_cache is not None:
+            hash_cache.close()
+
+    if not args.quiet:
+        print(f"{stats.get('duplicate_files', 0)} duplicate files in {writer.group_count} groups, "
+              f"{format_size(stats.get('reclaimable_bytes', 0))} can be freed, {stats.get('errors', 0)} errors",
+              file=sys.stderr)
+        if stats.get('unverified') and not args.verify:
+            print("Matched on file details only, the contents were not compared. Use --verify to hash them.", file=sys.stderr)
+        if stats.get('chunked_bytes'):
+            print(f"Block-level deduplication would save {format_size(stats['block_dedupe_bytes'])} "
+                  f"of {format_size(stats['chunked_bytes'])}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())